@@ -1,7 +1,11 @@
 import anndata as ad
-import pandas as pd
 import sccoda.util.comp_ana as mod
 
+import DA_analysis_scheduler as sched
+import DA_analysis_profiling as prof
+import DA_analysis_long_tables as lt
+import DA_analysis_resources as rsrc
+
 data_dir = "/home/CLUSTER/DA_analysis"  # CHANGE THIS DIRECTORY ON YOUR COMPUTER
 
 tax_levels = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus"]
@@ -12,30 +16,25 @@ def agg_ibs_data(author, level, data_dir):
     # read data
     subdir_name = f"{data_dir}/input"
     file_name = subdir_name + f"/{author.lower()}_{level.lower()}-agg.csv"
-    raw_data = pd.read_csv(file_name, index_col=0)
 
     # get taxonomic levels in the data
     tl = [x for x in tax_levels[:tax_levels.index(level) + 1]]
 
-    # extract counts
-    count_data = raw_data.pivot(index="Sample", columns=tl, values="Abundance")
+    # read in blocks straight into the count matrix, metadata from the first row of every sample
+    metadata_cols = [c for c in lt.read_header(file_name) if c not in ["Sample", "Abundance"] + tax_levels]
+    count_data, _, tax_info, metadata, _ = lt.read_long_table(file_name, "Sample", tl, "Abundance",
+                                                              meta_cols=metadata_cols)
+
     # get taxonomic tree (for data.var)
-    tax_info = pd.DataFrame(index=count_data.columns).reset_index()
     tax_index = tax_info.apply('*'.join, axis=1)
     tax_index = [s.replace("(", "") .replace(")", "") for s in tax_index]
     tax_info.index = tax_index
 
-    count_data.columns = tax_index
-
-    # get metadata
-    metadata_cols = raw_data.columns.drop(["Sample", "Abundance"] + tax_levels, errors="ignore")
-    metadata = raw_data.groupby("Sample").agg(dict([(x, "first") for x in metadata_cols]))
-
     ret = ad.AnnData(X=count_data, obs=metadata, var=tax_info)
     return ret
 
 
-def run_sccoda(author, level, data_dir, add=None, fdr_level=0.1):
+def run_sccoda(author, level, data_dir, add=None, fdr_level=0.1, budget=None, subset_workers=None):
     references = {
         "Genus": "Bacteria*Proteobacteria*Gammaproteobacteria*Burkholderiales*Sutterellaceae*Parasutterella",
         "Family": "Bacteria*Proteobacteria*Gammaproteobacteria*Burkholderiales*Sutterellaceae",
@@ -48,43 +47,72 @@ def run_sccoda(author, level, data_dir, add=None, fdr_level=0.1):
     if add is not None:
         data = data[data.obs[add[0]] == add[1]]
 
+    formula = "C(host_disease, Treatment('Healthy'))"
+
+    # runs that do not fit into the budget get a shorter chain or are fitted on balanced Healthy/IBS subsets
+    # (marked in the "Sampling" column of the result and in the resource_plan stage of its profile)
+    sampler_kwargs = {}
+    if budget is not None:
+        with prof.stage("resource_plan", shape=data.shape) as rec:
+            plan = rsrc.plan_sccoda(data.n_obs, data.n_vars, budget, n_workers=subset_workers)
+            rec.update(mode=rsrc.describe_plan(plan), est_mem_gb=round(plan["estimate"].mem_gb, 2),
+                       est_hours=round(plan["estimate"].hours, 2))
+        print(f"{author} {level}: {rsrc.describe_plan(plan)} run, about {plan['estimate'].mem_gb:.1f} GB and "
+              f"{plan['estimate'].hours:.1f} h each")
+        sampler_kwargs = plan["sampler_kwargs"]
+        if plan["mode"] == "subsampled":
+            effect_df = rsrc.run_subsampled(data, formula, references[level], fdr_level, plan)
+            return rsrc.mark_downscaled(effect_df, plan)
+
     model = mod.CompositionalAnalysis(
         data=data,
-        formula="C(host_disease, Treatment('Healthy'))",
+        formula=formula,
         reference_cell_type=references[level]
     )
-    result = model.sample_hmc()
+    result = model.sample_hmc(**sampler_kwargs)
     _, effect_df = result.summary_prepare(est_fdr = fdr_level)
 
+    if budget is not None:
+        effect_df = rsrc.mark_downscaled(effect_df, plan)
     return effect_df
 
 
-def one_author_new(author, levels, adds, model, data_dir, alpha=0.1, run_no=None):
+def run_sccoda_job(author, level, data_dir, add=None, alpha=0.1, budget=None, subset_workers=None):
+    return run_sccoda(author, level, data_dir, add=add, fdr_level=alpha, budget=budget, subset_workers=subset_workers)
+
 
-    for l in levels[1:]:
-        print(l)
+def one_author_new(author, levels, adds, model, data_dir, alpha=0.1, run_no=None, n_workers=None, threads_per_job=1,
+                   budget=None):
 
-        for a in adds:
-            print(a)
+    if model != "sccoda":
+        raise ValueError("Invalid model name!")
 
-            if model == "sccoda":
-                out = run_sccoda(author, l, data_dir, fdr_level=alpha, add=a)
-            else:
-                raise ValueError("Invalid model name!")
+    # every (level, add) combination is an independent scCODA run, so they are spread over a process pool.
+    # Runs listed in the manifest are skipped, so a resubmitted job continues where the last one stopped
+    jobs = sched.expand_grid({author: adds}, levels[1:], [model], [alpha], [run_no])
+    if n_workers is None:
+        n_workers = sched.default_n_workers(threads_per_job)
 
-            filename = f"{author.lower()}_{l.lower()}_"
-            if a is not None:
-                filename += f"{a[1]}_"
+    # opt-in budget of the whole job (rsrc.Budget, or DA_MEM_GB / DA_HOURS), the memory split between the runs of the
+    # pool; without one, every run samples the full data as before
+    run_kwargs = {}
+    if budget is None:
+        budget = rsrc.budget_from_env()
+    if budget is not None:
+        n_parallel = max(1, min(n_workers, len(jobs)))
+        if budget.mem_gb is not None:
+            budget = budget._replace(mem_gb=budget.mem_gb / n_parallel)
+        run_kwargs = {"budget": budget, "subset_workers": max(1, n_workers // n_parallel)}
 
-            if run_no:
-                out.to_csv(f"{data_dir}/output/{filename}{model}_alpha_{alpha}_{run_no}.csv")
-            else:
-                out.to_csv(f"{data_dir}/output/{filename}{model}_alpha_{alpha}.csv")
+    return sched.run_grid(jobs, data_dir, f"{data_dir}/output", runners={"sccoda": run_sccoda_job},
+                          n_workers=n_workers, threads_per_job=threads_per_job, run_kwargs=run_kwargs,
+                          manifest_file=f"{data_dir}/output/manifest.jsonl")
 
 
-model = "sccoda"
-alpha = 0.2
-run_no = 2
+if __name__ == "__main__":
+    model = "sccoda"
+    alpha = 0.2
+    run_no = 2
 
-author = "AGP"
-one_author_new(author, tax_levels, [None], model, data_dir, alpha, run_no=run_no)
+    author = "AGP"
+    one_author_new(author, tax_levels, [None], model, data_dir, alpha, run_no=run_no)
@@ -1,9 +1,15 @@
 import pandas as pd
 import anndata as ad
 import numpy as np
+import scipy.sparse as sp
 
 import sccoda.util.comp_ana as mod
 
+import DA_analysis_profiling as prof
+import DA_analysis_preprocessing as pp
+import DA_analysis_long_tables as lt
+import DA_analysis_taxonomy as tx
+
 data_path = "/home/CLUSTER/DA_analysis/input"  # CHANGE THIS DIRECTORY ON YOUR COMPUTER
 save_path = "/home/CLUSTER/DA_analysis/output"  # CHANGE THIS DIRECTORY ON YOUR COMPUTER
 
@@ -14,45 +20,71 @@ meta_col = ['host_disease', 'host_subtype', 'sequencing_tech', 'variable_region'
             'sample_storage_duration', 'sequencing_run', 'extraction_plate', 'author']
 
 
-def read_shared_ASVs(a1, a2, data_path):
-    raw = pd.read_csv(f"{data_path}/commonASV_{a1}-{a2}.csv", index_col=0)
-    raw["Type"] = raw.loc[:, tax_levels].fillna("_").apply('*'.join, axis=1)
+def densify(d):
+    # scCODA needs a dense count matrix
+    if sp.issparse(d.X):
+        return ad.AnnData(X=d.X.toarray(), obs=d.obs, var=d.var)
+    return d
+
+
+def read_shared_ASVs(a1, a2, data_path, sparse=False):
+    file_name = f"{data_path}/commonASV_{a1}-{a2}.csv"
+
+    # read in blocks straight into the (Sample x OTU) count matrix; metadata from the first row of every sample,
+    # taxonomy from the first row of every OTU. The per-author data are views of the combined data
+    table = lt.LongTable("Sample", "OTU", "Abundance", meta_cols=meta_col, col_meta_cols=tax_levels)
+    author_otus = set()
+    for chunk in lt.iter_chunks(file_name, ["Sample", "OTU", "Abundance"] + meta_col + tax_levels,
+                                categorical=["Sample", "OTU"], dtype={"Abundance": np.int64},
+                                text=meta_col + tax_levels):
+        table.update(chunk)
+        author_otus |= set(zip(chunk["author"].values, chunk["OTU"].astype(object).values))
+
+    counts_both, _, otus = table.matrix(sparse=sparse)
+    # the ~20 metadata columns repeat a few values each, held as categoricals
+    meta_both = tx.categorical_metadata(table.metadata())
+    tax_both = table.col_metadata()
+    tax_both.index = pd.Index(otus["OTU"].values, name="OTU")
+    tax = tax_both.loc[:, tax_levels].fillna("_")
+    tax_both["Type"] = tax.iloc[:, 0].str.cat([tax[c] for c in tax_levels[1:]], sep="*")
+    data_all = ad.AnnData(X=counts_both, obs=meta_both, var=tax_both)
 
-    raw_a1 = raw[raw["author"] == a1]
-    counts_a1 = raw_a1.pivot("Sample", "OTU", "Abundance")
-    meta_a1 = raw_a1.groupby("Sample").agg(dict([(x, "first") for x in meta_col]))
-    tax_a1 = raw_a1.groupby("OTU").agg(dict([(x, "first") for x in tax_levels + ["Type"]]))
-    data_a1 = ad.AnnData(X=counts_a1, obs=meta_a1, var=tax_a1)
+    def author_view(a):
+        otus = data_all.var.index.isin([o for x, o in author_otus if x == a])
+        return data_all[data_all.obs["author"] == a, otus]
 
-    raw_a2 = raw[raw["author"] == a2]
-    counts_a2 = raw_a2.pivot("Sample", "OTU", "Abundance")
-    meta_a2 = raw_a2.groupby("Sample").agg(dict([(x, "first") for x in meta_col]))
-    tax_a2 = raw_a2.groupby("OTU").agg(dict([(x, "first") for x in tax_levels + ["Type"]]))
-    data_a2 = ad.AnnData(X=counts_a2, obs=meta_a2, var=tax_a2)
+    data_a1 = author_view(a1)
+    data_a2 = author_view(a2)
+    data_both = data_all
 
     if a2 == "Pozuelo":
         data_a2 = data_a2[data_a2.obs["Collection"] == "1st"]
-        zero_sum = np.sum(data_a2.X, axis=0) > 0
+        zero_sum = np.asarray(data_a2.X.sum(axis=0)).ravel() > 0
         data_a2 = data_a2[:, zero_sum]
 
-    counts_both = raw.pivot("Sample", "OTU", "Abundance")
-    meta_both = raw.groupby("Sample").agg(dict([(x, "first") for x in meta_col]))
-    tax_both = raw.groupby("OTU").agg(dict([(x, "first") for x in tax_levels + ["Type"]]))
-    data_both = ad.AnnData(X=counts_both, obs=meta_both, var=tax_both)
-
-    if a2 == "Pozuelo":
         data_both = data_both[data_both.obs["Collection"] == "1st"]
 
     return data_a1, data_a2, data_both
 
 
-def run_model_shared(author1, author2, model, data_path, save_path, alpha=0.2, mode="all", total_scale=None):
-    data_a1, data_a2, data_both = read_shared_ASVs(author1, author2, data_path)
+def iter_shared_ASVs(pairs, data_path, sparse=False):
+    # load one author pair at a time, so only one shared ASV table is held in memory
+    for a1, a2 in pairs:
+        yield a1, a2, read_shared_ASVs(a1, a2, data_path, sparse=sparse)
+
+
+def run_model_shared(author1, author2, model, data_path, save_path, alpha=0.2, mode="all", total_scale=None, sparse=False,
+                     data=None, n_chains=None):
+    if data is None:
+        data = read_shared_ASVs(author1, author2, data_path, sparse=sparse)
+    data_a1, data_a2, data_both = data
 
     def model_run(d, m, alpha):
 
         if total_scale is not None:
-            d.X = np.round(d.X/np.sum(d.X, axis=1, keepdims=True)*total_scale, 0).astype(int)
+            # rescaled copy in blocks of rows (sparse: only the stored entries); d itself is a view and stays unchanged
+            with prof.stage("rescale", shape=d.shape):
+                d = pp.scale_to_total(d, total_scale)
 
         if m == "sccoda":
             references = {
@@ -67,13 +99,24 @@ def run_model_shared(author1, author2, model, data_path, save_path, alpha=0.2, m
             ref = d.var[d.var["Type"] == references["ASV"]].index[0]
             print(ref)
 
-            model = mod.CompositionalAnalysis(
-                data=d,
-                formula="C(host_disease, Treatment('Healthy'))",
-                reference_cell_type=ref
-            )
-            result = model.sample_hmc(num_results=20000, num_burnin=5000)
-            _, effect_df = result.summary_prepare(est_fdr=alpha)
+            formula = "C(host_disease, Treatment('Healthy'))"
+            if n_chains is None:
+                with prof.stage("model_setup", shape=d.shape):
+                    model = mod.CompositionalAnalysis(
+                        data=densify(d),
+                        formula=formula,
+                        reference_cell_type=ref
+                    )
+                with prof.stage("sampling"):
+                    result = model.sample_hmc(num_results=20000, num_burnin=5000)
+            else:
+                # parallel chains, stopped early once R-hat/ESS of the inclusion indicators converged
+                import DA_analysis_sccoda_sampling as ss
+                with prof.stage("sampling", shape=d.shape, n_chains=n_chains):
+                    result = ss.sample_hmc_parallel(densify(d), formula, ref, n_chains=n_chains,
+                                                    num_results=20000, num_burnin=5000)
+            with prof.stage("summary_prepare"):
+                _, effect_df = result.summary_prepare(est_fdr=alpha)
 
             out = effect_df
             out["is_da"] = [True if x != 0 else False for x in out["Final Parameter"]]
@@ -85,37 +128,53 @@ def run_model_shared(author1, author2, model, data_path, save_path, alpha=0.2, m
         res = d.var.merge(out, left_index=True, right_index=True)
         return res
 
+    def run_part(d, part, check_groups=True):
+        # stage times and memory go to {result file without .csv}.profile.jsonl
+        out_file = save_path + f"/shared_{author1}{author2}_{model}_{total_scale}_{part}.csv"
+        with prof.profiled(out_file, authors=[author1, author2], model=model, part=part):
+            if check_groups and len(pd.unique(d.obs["host_disease"])) < 2:
+                print("Common ASVs were not found in both groups! Skipping...")
+                da = pd.DataFrame()
+            else:
+                da = model_run(d, model, alpha)
+            with prof.stage("write_csv"):
+                da.to_csv(out_file)
+        return da
+
     out = []
 
     if mode == "all" or mode == "a1":
         print(f"Running {author1}")
-        if len(pd.unique(data_a1.obs["host_disease"])) < 2:
-            print("Common ASVs were not found in both groups! Skipping...")
-            da_a1 = pd.DataFrame()
-        else:
-            da_a1 = model_run(data_a1, model, alpha)
-        da_a1.to_csv(save_path + f"/shared_{author1}{author2}_{model}_{total_scale}_a1.csv")
-        out.append(da_a1)
+        out.append(run_part(data_a1, "a1"))
 
     if mode == "all" or mode == "a2":
         print(f"Running {author2}")
-        if len(pd.unique(data_a2.obs["host_disease"])) < 2:
-            print("Common ASVs were not found in both groups! Skipping...")
-            da_a2 = pd.DataFrame()
-        else:
-            da_a2 = model_run(data_a2, model, alpha)
-        da_a2.to_csv(save_path + f"/shared_{author1}{author2}_{model}_{total_scale}_a2.csv")
-        out.append(da_a2)
+        out.append(run_part(data_a2, "a2"))
 
     if mode == "all" or mode == "combined":
         print(f"Running Combined data")
-        da_both = model_run(data_both, model, alpha)
-        da_both.to_csv(save_path + f"/shared_{author1}{author2}_{model}_{total_scale}_combined.csv")
-        out.append(da_both)
+        out.append(run_part(data_both, "combined", check_groups=False))
+
+    return out
+
 
+def run_shared_pairs(pairs, model, data_path, save_path, **kwargs):
+    out = {}
+    for a1, a2, data in iter_shared_ASVs(pairs, data_path, sparse=kwargs.get("sparse", False)):
+        out[(a1, a2)] = run_model_shared(a1, a2, model, data_path, save_path, data=data, **kwargs)
     return out
 
 
-author1 = "Nagel"
-author2 = "Pozuelo"
-sccoda_res = run_model_shared(author1, author2, "sccoda", data_path=data_path, save_path=save_path, total_scale=5161.0, mode="all")
+if __name__ == "__main__":
+    author1 = "Nagel"
+    author2 = "Pozuelo"
+    sccoda_res = run_model_shared(author1, author2, "sccoda", data_path=data_path, save_path=save_path, total_scale=5161.0, mode="all")
+
+    # alternatively, one MCMC chain per CPU of the job (see scCODA_common.sh), stopped early once the chains converged.
+    # Changes the sampler, so the results differ from the published single-chain run:
+    # sccoda_res = run_model_shared(author1, author2, "sccoda", data_path=data_path, save_path=save_path,
+    #                               total_scale=5161.0, mode="all", n_chains=8)
+
+    # all pairs with shared ASVs (commonASV_{a1}-{a2}.csv in data_path) can be run in one go:
+    # run_shared_pairs([("Nagel", "Pozuelo"), ("Hugerth", "Zhu"), ("Liu", "Zhuang"), ("Lopresti", "Ringel")],
+    #                  "sccoda", data_path, save_path, total_scale=5161.0)
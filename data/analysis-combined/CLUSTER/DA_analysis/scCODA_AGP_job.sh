@@ -10,4 +10,10 @@
 # This script was written for a cluster running slurm. Please replace all paths (input, output, data and python installation), partition names, etc. in this script with the ones fitting your cluster configuration
 # Also change the data/output paths in the run_AGP_scCODA script!
 
+# Optional memory/time budget of the whole job, e.g. for a node with 64 GB. Runs that do not fit are downscaled (shorter
+# chain or balanced Healthy/IBS subsets, see DA_analysis_resources.py) and marked in the "Sampling" column of their
+# result. Without DA_MEM_GB/DA_HOURS, all runs sample the full data as in the published analysis:
+# export DA_MEM_GB=60
+# export DA_HOURS=48
+
 /home/anaconda3/envs/metaIBS/bin/python /home/CLUSTER/DA_analysis/run_AGP_scCODA.py
\ No newline at end of file
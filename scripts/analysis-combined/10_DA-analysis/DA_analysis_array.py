@@ -0,0 +1,298 @@
+import os
+import sys
+import glob
+import json
+import math
+import time
+import argparse
+import subprocess
+
+import DA_analysis_scheduler as sched
+import DA_analysis_results_store as rs
+
+# Fan-out of the DA grid (authors x levels x adds x models x alphas x run_nos) over SLURM array tasks.
+#
+#   python DA_analysis_array.py plan grid.json plan_dir [--submit]   # shard the grid, write one sbatch script per group
+#   python DA_analysis_array.py task plan_dir GROUP [--shard i]      # run one shard (default: $SLURM_ARRAY_TASK_ID)
+#   python DA_analysis_array.py local plan_dir [--parallel n]        # run all shards as local processes instead
+#   python DA_analysis_array.py gather plan_dir [--store file]       # merge the shard stores, report missing runs
+#
+# grid.json:
+# {
+#   "data_dir": "...", "save_dir": "...",
+#   "author_adds": {"Nagel": [null], "Hugerth": [["sample_type", "stool"], ["sample_type", "sigmoid"]], ...},
+#   "subdirs": {"Nagel": "Nagel-2016", ...},              (optional, result subdirectory of every author)
+#   "levels": ["Phylum", ...], "models": ["sccoda", ...], "alphas": [0.2], "run_nos": [2],
+#   "resources": {"sccoda": {"cpus": 8}, "sccoda:AGP": {"mem": "500G", "time": "3-00:00:00"}},   (optional)
+#   "jobs_per_task": {"sccoda": 1},                        (optional, default: default_jobs_per_task)
+#   "threads_per_job": 1, "python": "/path/to/python", "slurm_options": ["-p cpu_p", "--nice=10000"]   (optional)
+# }
+#
+# Relative data_dir/save_dir are relative to this scripts directory, where the tasks run.
+# Jobs of one model share the resources of that model. A "model:author" entry in "resources" moves the runs of this
+# author into their own array with these resources (e.g. scCODA on AGP).
+# Every task writes result csv files like run_grid, and its own manifest and results store in plan_dir/shards.
+# Many nodes never write to the same SQLite file; gather merges the shard stores into one store for
+# util.read_authors_results(..., store=...).
+
+default_resources = {
+    "sccoda": {"cpus": 4, "mem": "16G", "time": "12:00:00"},
+    "ANCOMBC": {"cpus": 1, "mem": "8G", "time": "02:00:00"},
+    "LinDA": {"cpus": 1, "mem": "4G", "time": "01:00:00"},
+}
+
+# scCODA runs take hours, the R models seconds to minutes
+default_jobs_per_task = {
+    "sccoda": 1,
+    "ANCOMBC": 20,
+    "LinDA": 50,
+}
+
+# seconds between checks of the running local tasks (run_local)
+poll_interval = 1.
+
+
+def read_config(config_file):
+    with open(config_file) as f:
+        config = json.load(f)
+    for k in ["data_dir", "save_dir", "author_adds", "levels", "models", "alphas"]:
+        if k not in config:
+            raise ValueError(f"{config_file}: {k} is missing!")
+    return config
+
+
+def grid_jobs(config):
+    author_adds = dict([(a, [None if x is None else tuple(x) for x in adds]) for a, adds in config["author_adds"].items()])
+    return sched.expand_grid(author_adds, config["levels"], config["models"], config["alphas"],
+                             config.get("run_nos", [None]))
+
+
+def job_group(job, resources):
+    # array a job belongs to
+    key = f"{job.model}:{job.author}"
+    return key.replace(":", "_") if key in resources else job.model
+
+
+def group_resources(group, jobs, config):
+    model = jobs[0].model
+    res = dict(default_resources.get(model, {}), **config.get("resources", {}).get(model, {}))
+    key = f"{model}:{jobs[0].author}"
+    if group != model:
+        res.update(config["resources"][key])
+    return res
+
+
+def shard_jobs(jobs, config):
+    # {group: [shard jobs, ...]}. Jobs are dealt out round-robin, so large datasets are spread over the shards
+    resources = config.get("resources", {})
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job_group(job, resources), []).append(job)
+
+    out = {}
+    for group, g_jobs in groups.items():
+        per_task = config.get("jobs_per_task", {}).get(g_jobs[0].model, default_jobs_per_task.get(g_jobs[0].model, 1))
+        n_shards = math.ceil(len(g_jobs) / per_task)
+        out[group] = [g_jobs[i::n_shards] for i in range(n_shards)]
+    return out
+
+
+def job_to_json(job):
+    return [job.author, job.level, None if job.add is None else list(job.add), job.model, job.alpha, job.run_no]
+
+
+def job_from_json(x):
+    author, level, add, model, alpha, run_no = x
+    return sched.Job(author, level, None if add is None else tuple(add), model, alpha, run_no)
+
+
+def sbatch_script(plan_dir, group, n_shards, res, config):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    log_dir = os.path.join(os.path.abspath(plan_dir), "logs")
+    lines = [
+        "#!/bin/bash",
+        f"#SBATCH -J DA_{group}",
+        f"#SBATCH -o {log_dir}/{group}_%a.o",
+        f"#SBATCH -e {log_dir}/{group}_%a.e",
+        f"#SBATCH --array=0-{n_shards - 1}",
+        f"#SBATCH -c {res.get('cpus', 1)}",
+        f"#SBATCH --mem={res.get('mem', '4G')}",
+        f"#SBATCH -t {res.get('time', '12:00:00')}",
+    ]
+    lines += [f"#SBATCH {x}" for x in config.get("slurm_options", [])]
+    if "partition" in res:
+        lines.append(f"#SBATCH -p {res['partition']}")
+    lines += [
+        "",
+        f"cd {script_dir}",
+        f"{config.get('python', sys.executable)} DA_analysis_array.py task {os.path.abspath(plan_dir)} {group}",
+        "",
+    ]
+    return "\n".join(lines)
+
+
+def plan(config_file, plan_dir, submit=False):
+    config = read_config(config_file)
+    shards = shard_jobs(grid_jobs(config), config)
+
+    os.makedirs(os.path.join(plan_dir, "logs"), exist_ok=True)
+    os.makedirs(os.path.join(plan_dir, "shards"), exist_ok=True)
+    with open(os.path.join(plan_dir, "config.json"), "w") as f:
+        json.dump(config, f, indent=1)
+
+    with open(os.path.join(plan_dir, "jobs.jsonl"), "w") as f:
+        for group, g_shards in shards.items():
+            for i, s in enumerate(g_shards):
+                for job in s:
+                    f.write(json.dumps({"group": group, "shard": i, "job": job_to_json(job)}) + "\n")
+
+    scripts = []
+    for group, g_shards in shards.items():
+        res = group_resources(group, g_shards[0], config)
+        script = os.path.join(plan_dir, f"{group}.sbatch")
+        with open(script, "w") as f:
+            f.write(sbatch_script(plan_dir, group, len(g_shards), res, config))
+        scripts.append(script)
+        print(f"{group}: {sum([len(s) for s in g_shards])} jobs in {len(g_shards)} tasks ({res}) -> {script}")
+
+    if submit:
+        for script in scripts:
+            subprocess.run(["sbatch", script], check=True)
+    return shards
+
+
+def read_plan(plan_dir):
+    with open(os.path.join(plan_dir, "config.json")) as f:
+        config = json.load(f)
+    shards = {}
+    with open(os.path.join(plan_dir, "jobs.jsonl")) as f:
+        for line in f:
+            entry = json.loads(line)
+            shards.setdefault(entry["group"], {}).setdefault(entry["shard"], []).append(job_from_json(entry["job"]))
+    return config, shards
+
+
+def shard_file(plan_dir, group, shard, ext):
+    return os.path.join(plan_dir, "shards", f"{group}_{shard}.{ext}")
+
+
+def run_task(plan_dir, group, shard=None, n_workers=None):
+    if shard is None:
+        shard = int(os.environ["SLURM_ARRAY_TASK_ID"])
+    config, shards = read_plan(plan_dir)
+    jobs = shards[group][shard]
+
+    initializer = None
+    if any([j.model in ("ANCOMBC", "LinDA") for j in jobs]):
+        import DA_analysis_r_backend as rb
+        initializer = rb.warm_up
+
+    results = sched.run_grid(jobs, config["data_dir"], config["save_dir"], subdirs=config.get("subdirs"),
+                             n_workers=n_workers, threads_per_job=config.get("threads_per_job", 1),
+                             manifest_file=shard_file(plan_dir, group, shard, "jsonl"),
+                             store_file=shard_file(plan_dir, group, shard, "sqlite"), initializer=initializer)
+    failed = [j for j, r in results.items() if isinstance(r, Exception)]
+    print(f"{group} shard {shard}: {len(results) - len(failed)} of {len(jobs)} jobs done")
+    return failed
+
+
+def run_local(plan_dir, parallel=None, cpus_per_task=None):
+    # the same tasks as the SLURM arrays, as local processes: at most `parallel` at a time, each with
+    # cpus_per_task (default: the group's cpus) CPUs
+    plan_dir = os.path.abspath(plan_dir)
+    config, shards = read_plan(plan_dir)
+    tasks = [(group, i) for group, g_shards in shards.items() for i in sorted(g_shards)]
+    if parallel is None:
+        parallel = max(1, (os.cpu_count() or 1) // 2)
+
+    def start(group, i):
+        env = dict(os.environ)
+        cpus = cpus_per_task or group_resources(group, shards[group][i], config).get("cpus", 1)
+        env["SLURM_CPUS_PER_TASK"] = str(cpus)
+        env["SLURM_ARRAY_TASK_ID"] = str(i)
+        log = open(os.path.join(plan_dir, "logs", f"{group}_{i}.o"), "w")
+        p = subprocess.Popen([sys.executable, os.path.abspath(__file__), "task", plan_dir, group],
+                             cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=log, stderr=subprocess.STDOUT)
+        return p, log
+
+    running = []
+    failed = []
+    while tasks or running:
+        while tasks and len(running) < parallel:
+            group, i = tasks.pop(0)
+            running.append(((group, i),) + start(group, i))
+        # a free slot is refilled as soon as any task finished, not only the oldest one
+        finished = [r for r in running if r[1].poll() is not None]
+        if not finished:
+            time.sleep(poll_interval)
+            continue
+        for task, p, log in finished:
+            running.remove((task, p, log))
+            if p.returncode != 0:
+                failed.append(task)
+            log.close()
+            print(f"Task {task[0]} {task[1]}: {'failed' if p.returncode else 'done'}")
+    return failed
+
+
+def gather(plan_dir, store_file=None):
+    # merge the stores of all tasks, and list the runs that no task finished
+    config, shards = read_plan(plan_dir)
+    if store_file is None:
+        store_file = os.path.join(plan_dir, "DA_results.sqlite")
+
+    shard_stores = sorted(glob.glob(os.path.join(plan_dir, "shards", "*.sqlite")))
+    n = rs.merge_stores(store_file, shard_stores)
+
+    done = {}
+    for f in glob.glob(os.path.join(plan_dir, "shards", "*.jsonl")):
+        done.update(sched.read_manifest(f))
+    missing = [(group, i, job) for group, g_shards in shards.items() for i, s in g_shards.items() for job in s
+               if sched.job_key(job) not in done]
+
+    print(f"{n} results from {len(shard_stores)} tasks merged into {store_file}")
+    for group, i, job in missing:
+        print(f"Missing: {group} shard {i}: {job}")
+    return store_file, missing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the DA grid as SLURM array tasks or local processes")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("plan", help="shard the grid and write the sbatch scripts")
+    p.add_argument("config")
+    p.add_argument("plan_dir")
+    p.add_argument("--submit", action="store_true", help="submit the arrays with sbatch")
+
+    p = sub.add_parser("task", help="run one shard")
+    p.add_argument("plan_dir")
+    p.add_argument("group")
+    p.add_argument("--shard", type=int, default=None, help="default: $SLURM_ARRAY_TASK_ID")
+    p.add_argument("--workers", type=int, default=None, help="default: $SLURM_CPUS_PER_TASK / threads_per_job")
+
+    p = sub.add_parser("local", help="run all shards as local processes")
+    p.add_argument("plan_dir")
+    p.add_argument("--parallel", type=int, default=None, help="tasks at the same time")
+    p.add_argument("--cpus-per-task", type=int, default=None)
+
+    p = sub.add_parser("gather", help="merge the results of all shards")
+    p.add_argument("plan_dir")
+    p.add_argument("--store", default=None, help="default: plan_dir/DA_results.sqlite")
+
+    args = parser.parse_args(argv)
+    if args.command == "plan":
+        plan(args.config, args.plan_dir, submit=args.submit)
+    elif args.command == "task":
+        if run_task(args.plan_dir, args.group, args.shard, n_workers=args.workers):
+            sys.exit(1)
+    elif args.command == "local":
+        if run_local(args.plan_dir, parallel=args.parallel, cpus_per_task=args.cpus_per_task):
+            sys.exit(1)
+    elif args.command == "gather":
+        if gather(args.plan_dir, store_file=args.store)[1]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
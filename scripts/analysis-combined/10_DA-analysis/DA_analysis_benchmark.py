@@ -0,0 +1,373 @@
+import os
+import sys
+import time
+import types
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import importlib.util
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import DA_analysis_util_functions as util
+
+# read_shared_ASVs lives in the cluster script
+cluster_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../../data/analysis-combined/CLUSTER/DA_analysis")
+
+tax_levels = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus"]
+shared_tax_levels = tax_levels + ["Species"]
+shared_meta_col = ['host_disease', 'host_subtype', 'sequencing_tech', 'variable_region', 'sample_type', 'Collection',
+                   'host_sex', 'host_ID', 'host_age', 'host_bmi', 'collection_date',
+                   'Bristol', 'IBS_SSS', 'sex_flexibl', 'host_psy', 'ID_flexibl',
+                   'sample_storage_duration', 'sequencing_run', 'extraction_plate', 'author']
+
+covariate = "C(host_disease, Treatment('Healthy'))[T.IBS]"
+
+
+# synthetic data
+
+def make_taxonomy(n_taxa, levels=tax_levels):
+    # balanced tree: every taxon on one level has ~3 children on the next one
+    ids = np.arange(n_taxa)
+    tax = {}
+    for l in reversed(levels[1:]):
+        tax[l] = ids
+        ids = ids // 3
+    tax["Kingdom"] = np.zeros(n_taxa, dtype=int)
+
+    # reference taxa of run_sccoda and model_run are always part of the tree
+    ref = ["Bacteria", "Proteobacteria", "Gammaproteobacteria", "Burkholderiales", "Sutterellaceae",
+           "Parasutterella", "excrementihominis"]
+    out = pd.DataFrame(dict([(l, [f"{l}_{i}" for i in tax[l]]) for l in levels]))
+    out.iloc[0] = ref[:len(levels)]
+    out["Kingdom"] = "Bacteria"
+    return out
+
+
+def make_counts(n_samples, n_taxa, zero_frac=0.6, seed=0):
+    rng = np.random.default_rng(seed)
+    mean = rng.lognormal(3, 1.5, size=n_taxa)
+    counts = rng.poisson(mean, size=(n_samples, n_taxa))
+    counts[rng.random((n_samples, n_taxa)) < zero_frac] = 0
+    # every sample needs counts for the reference taxon
+    counts[:, 0] += 1
+    return counts
+
+
+def make_metadata(samples, author, meta_cols, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(samples)
+    meta = pd.DataFrame({
+        "host_disease": np.where(np.arange(n) % 2 == 0, "Healthy", "IBS"),
+        "Collection": np.where(np.arange(n) % 3 == 2, "2nd", "1st"),
+        "sample_type": "stool",
+        "author": author,
+        "host_age": rng.integers(18, 80, size=n),
+    }, index=samples)
+    for c in meta_cols:
+        if c not in meta.columns:
+            meta[c] = "NA"
+    return meta.loc[:, meta_cols]
+
+
+def write_long(file_name, counts, samples, otus, taxa, meta, start=0, header=True):
+    # long format with one row per (sample, taxon) and the metadata repeated on every row, as DataFrame.to_csv writes
+    # it. The lines are formatted one sample at a time from preformatted metadata and taxonomy fields, so the long
+    # table is never held in memory (it has n_samples * n_taxa rows). Returns the index of the next row
+    tax = [",".join(map(str, t)) for t in taxa.itertuples(index=False)]
+    with open(file_name, "w" if header else "a") as f:
+        if header:
+            f.write(",".join(["", "OTU", "Sample", "Abundance"] + list(meta.columns) + list(taxa.columns)) + "\n")
+        i = start
+        for sample, m, row in zip(samples, meta.itertuples(index=False), counts):
+            m = ",".join(map(str, m))
+            f.write("".join([f"{i + j},{o},{sample},{c},{m},{t}\n"
+                             for j, (o, c, t) in enumerate(zip(otus, row.tolist(), tax))]))
+            i += len(otus)
+    return i
+
+
+def write_agg_tables(data_dir, author, n_samples, n_taxa, levels=tax_levels[1:], seed=0):
+    # same layout and columns as the {author}_{level}-agg.csv tables of 00_TaxaAggregation.R
+    subdir = os.path.join(data_dir, f"{author}-2000")
+    os.makedirs(subdir, exist_ok=True)
+
+    taxa = make_taxonomy(n_taxa)
+    counts = make_counts(n_samples, n_taxa, seed=seed)
+    samples = np.array([f"{author}_{i}" for i in range(n_samples)])
+    meta = make_metadata(samples, author, ["host_disease", "host_sex", "host_age", "host_subtype", "sample_type",
+                                           "author", "Collection"], seed=seed)
+
+    files = []
+    for l in levels:
+        tl = tax_levels[:tax_levels.index(l) + 1]
+        codes, uniques = pd.factorize(util.join_taxonomy(taxa.loc[:, tl]))
+        onehot = np.zeros((n_taxa, len(uniques)), dtype=counts.dtype)
+        onehot[np.arange(n_taxa), codes] = 1
+
+        file_name = os.path.join(subdir, f"{author.lower()}_{l.lower()}-agg.csv")
+        # taxonomy of every aggregated taxon: the row of its first member, in the order of factorize
+        first = np.unique(codes, return_index=True)[1]
+        write_long(file_name, counts @ onehot, samples, [f"ASV_{j}" for j in range(len(uniques))],
+                   taxa.loc[:, tl].iloc[first].reset_index(drop=True), meta)
+        files.append(file_name)
+
+    return files
+
+
+def write_shared_table(data_path, a1, a2, n_samples, n_taxa, seed=0):
+    # same columns as the commonASV_{a1}-{a2}.csv tables
+    taxa = make_taxonomy(n_taxa, shared_tax_levels)
+    otus = [f"ASV_{j}" for j in range(n_taxa)]
+    file_name = os.path.join(data_path, f"commonASV_{a1}-{a2}.csv")
+    row = 0
+    for i, a in enumerate([a1, a2]):
+        samples = np.array([f"{a}_{j}" for j in range(n_samples // 2)])
+        counts = make_counts(len(samples), n_taxa, seed=seed + i)
+        row = write_long(file_name, counts, samples, otus, taxa, make_metadata(samples, a, shared_meta_col, seed=seed + i),
+                         start=row, header=i == 0)
+    return file_name
+
+
+def stub_effects(var_names, seed=0):
+    rng = np.random.default_rng(seed)
+    n = len(var_names)
+    effect = rng.normal(size=n) * (rng.random(n) < 0.2)
+    return effect, rng.random(n)
+
+
+def write_results(data_dir, author, n_taxa, alpha=0.1, seed=0):
+    # scCODA and LinDA result tables with the columns and file names the runners produce
+    subdir = os.path.join(data_dir, f"{author}-2000")
+    os.makedirs(subdir, exist_ok=True)
+    taxa = make_taxonomy(n_taxa)
+
+    for l in tax_levels[1:]:
+        names = pd.unique(util.join_taxonomy(taxa.loc[:, tax_levels[:tax_levels.index(l) + 1]]))
+        effect, p = stub_effects(names, seed)
+
+        sccoda = pd.DataFrame({"Covariate": covariate, "Cell Type": names, "Final Parameter": effect,
+                               "Inclusion probability": p}).set_index("Covariate")
+        sccoda.to_csv(os.path.join(subdir, f"{author.lower()}_{l.lower()}_sccoda_alpha_{alpha}.csv"))
+
+        linda = pd.DataFrame({"log2FoldChange": effect, "stat": effect * 3, "pvalue": p, "padj": p,
+                              "reject": (effect != 0).astype(int)}, index=names)
+        linda.to_csv(os.path.join(subdir, f"{author.lower()}_{l.lower()}_LinDA_alpha_{alpha}.csv"))
+
+
+# stubbed sampler and R backends: the data path runs as usual, the model fits are replaced by random effects
+
+class StubResult:
+    def __init__(self, var_names):
+        self.var_names = var_names
+
+    def summary_prepare(self, est_fdr=0.05):
+        effect, p = stub_effects(self.var_names)
+        effect_df = pd.DataFrame({"Final Parameter": effect, "Inclusion probability": p},
+                                 index=pd.MultiIndex.from_product([[covariate], self.var_names],
+                                                                  names=["Covariate", "Cell Type"]))
+        return None, effect_df
+
+
+class StubCompositionalAnalysis:
+    def __init__(self, data, formula, reference_cell_type):
+        if reference_cell_type not in data.var.index:
+            raise ValueError(f"Reference {reference_cell_type} not in data!")
+        self.data = data
+
+    def sample_hmc(self, *args, **kwargs):
+        return StubResult(self.data.var.index)
+
+
+def stub_fit_ancombc(datasets, alpha=0.05, covariate_column="host_disease", **kwargs):
+    out = []
+    for d in datasets:
+        util.rb.count_matrix(d)
+        effect, p = stub_effects(d.var.index)
+        out.append(pd.DataFrame({"beta": effect, "q_val": p, "is_da": effect != 0}, index=d.var.index))
+    return out
+
+
+def stub_fit_linda(datasets, alpha=0.05, formula="host_disease"):
+    out = []
+    for d in datasets:
+        util.rb.count_matrix(d)
+        effect, p = stub_effects(d.var.index)
+        out.append(pd.DataFrame({"stat": effect, "padj": p, "reject": (effect != 0).astype(int)}, index=d.var.index))
+    return out
+
+
+@contextmanager
+def stub_backends(*modules):
+    # modules: util and/or the cluster script, everything that calls mod.CompositionalAnalysis or the R backend
+    old = []
+    for m in modules:
+        old.append((m, "mod", m.mod))
+        m.mod = types.SimpleNamespace(CompositionalAnalysis=StubCompositionalAnalysis)
+    for name, f in [("fit_ancombc", stub_fit_ancombc), ("fit_linda", stub_fit_linda)]:
+        old.append((util.rb, name, getattr(util.rb, name)))
+        setattr(util.rb, name, f)
+    try:
+        yield
+    finally:
+        for m, name, x in old:
+            setattr(m, name, x)
+
+
+# measurement
+
+def shape_of(x):
+    if hasattr(x, "shape"):
+        return tuple(x.shape)
+    if isinstance(x, dict):
+        return dict([(k, shape_of(v)) for k, v in x.items()])
+    if isinstance(x, (tuple, list)):
+        return [shape_of(v) for v in x]
+    return None
+
+
+def measure(stage, f, *args, **kwargs):
+    # wall time and peak memory (python + numpy allocations) of one stage
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        out = f(*args, **kwargs)
+        wall = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    record = {"stage": stage, "wall_s": round(wall, 4), "peak_mb": round(peak / 2**20, 2), "shape": str(shape_of(out))}
+    return out, record
+
+
+# backends that DA_analysis_util_functions only imports when a model is fitted or a tree is plotted
+heavy_modules = ["tensorflow", "tensorflow_probability", "sccoda", "rpy2", "toytree", "toyplot"]
+
+
+def import_time(module="DA_analysis_util_functions"):
+    # import time of `module` in a fresh interpreter, and the heavy backends that were imported with it
+    code = (
+        "import sys, time\n"
+        "t = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(time.perf_counter() - t)\n"
+        f"print(','.join(sorted(set([m.split('.')[0] for m in sys.modules]) & set({heavy_modules!r}))))\n"
+    )
+    out = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                         capture_output=True, text=True, check=True).stdout.splitlines()
+    return {"import_s": float(out[0]), "heavy_modules": out[1] if len(out) > 1 else ""}
+
+
+def load_cluster_script(name="run_common_NagPoz"):
+    # the cluster script imports sccoda (and with it TensorFlow) at the top; it is loaded with stub sccoda modules, so
+    # the benchmark runs without scCODA installed
+    comp_ana = types.ModuleType("sccoda.util.comp_ana")
+    comp_ana.CompositionalAnalysis = StubCompositionalAnalysis
+    stubs = {"sccoda": types.ModuleType("sccoda"), "sccoda.util": types.ModuleType("sccoda.util"),
+             "sccoda.util.comp_ana": comp_ana}
+    stubs["sccoda"].util = stubs["sccoda.util"]
+    stubs["sccoda.util"].comp_ana = comp_ana
+
+    old = dict([(k, sys.modules.get(k)) for k in stubs])
+    sys.modules.update(stubs)
+    try:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(cluster_dir, f"{name}.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        for k, m in old.items():
+            if m is None:
+                sys.modules.pop(k, None)
+            else:
+                sys.modules[k] = m
+    return module
+
+
+def run_benchmark(n_samples, n_taxa, work_dir, n_authors=3, level="Genus", sparse=False, stages=None, seed=0):
+    data_dir = os.path.join(work_dir, "agg") + "/"
+    results_dir = os.path.join(work_dir, "results") + "/"
+    shared_dir = os.path.join(work_dir, "shared")
+    for d in [data_dir, results_dir, shared_dir]:
+        os.makedirs(d, exist_ok=True)
+
+    authors = [f"Synth{i}" for i in range(n_authors)]
+    adds = dict([(a, [None]) for a in authors])
+
+    records = []
+
+    def run(stage, f, *args, **kwargs):
+        # the synthetic tables are always needed, even if their generation is not reported
+        if stages is not None and stage not in stages:
+            return f(*args, **kwargs) if stage.startswith("generate") else None
+        out, record = measure(stage, f, *args, **kwargs)
+        records.append(dict(n_samples=n_samples, n_taxa=n_taxa, **record))
+        print(f"{n_samples:>7} samples, {n_taxa:>5} taxa | {stage:<28} {record['wall_s']:>9.3f} s {record['peak_mb']:>10.1f} MB")
+        return out
+
+    # data generation is not part of the pipeline, but its cost is reported as well
+    run("generate_agg", write_agg_tables, data_dir, authors[0], n_samples, n_taxa, seed=seed)
+    run("generate_results", lambda: [write_results(results_dir, a, n_taxa, seed=seed + i) for i, a in enumerate(authors)])
+    run("generate_shared", write_shared_table, shared_dir, "Nagel", "Pozuelo", n_samples, n_taxa, seed=seed)
+
+    imported = run("import_util", import_time)
+    if imported is not None:
+        print(f"import DA_analysis_util_functions: {imported['import_s']:.3f} s, "
+              f"heavy modules: {imported['heavy_modules'] or 'none'}")
+
+    # the first runner loads the data, the others reuse it from the in-process cache
+    util.clear_data_cache()
+    cluster = load_cluster_script()
+    with stub_backends(util, cluster):
+        run("agg_ibs_data", util.agg_ibs_data, authors[0], level, data_dir, sparse=sparse)
+        run("run_sccoda", util.run_sccoda, authors[0], level, data_dir, sparse=sparse)
+        run("run_ancombc_model", util.run_ancombc_model, authors[0], level, data_dir, sparse=sparse)
+        run("run_linda_model", util.run_linda_model, authors[0], level, data_dir, sparse=sparse)
+        run("read_shared_ASVs", cluster.read_shared_ASVs, "Nagel", "Pozuelo", shared_dir, sparse=sparse)
+
+    res = {}
+    for m in ["sccoda", "LinDA"]:
+        res[m] = run(f"read_authors_results_{m}", util.read_authors_results, authors, results_dir, m, adds=adds, alpha=0.1)
+        if res[m] is not None:
+            run(f"get_significances_{m}", util.get_significances, res[m], m)
+
+    if res["sccoda"] is not None:
+        genus_res = res["sccoda"]["Genus"]
+        run("get_phylo_levels", util.get_phylo_levels, genus_res, "Genus")
+        run("df2newick", util.df2newick, genus_res.reset_index(drop=True))
+
+    return pd.DataFrame(records)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time and peak memory of the DA data path on synthetic tables")
+    parser.add_argument("--samples", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--taxa", type=int, nargs="+", default=[200])
+    parser.add_argument("--authors", type=int, default=3)
+    parser.add_argument("--level", default="Genus")
+    parser.add_argument("--sparse", action="store_true")
+    parser.add_argument("--stages", nargs="+", default=None, help="only run these stages")
+    parser.add_argument("--work-dir", default=None, help="keep the synthetic tables here (default: temporary directory)")
+    parser.add_argument("--out", default=None, help="append the results to this csv")
+    args = parser.parse_args(argv)
+
+    out = []
+    for n_samples in args.samples:
+        for n_taxa in args.taxa:
+            with tempfile.TemporaryDirectory() as tmp:
+                work_dir = tmp if args.work_dir is None else os.path.join(args.work_dir, f"{n_samples}_{n_taxa}")
+                out.append(run_benchmark(n_samples, n_taxa, work_dir, n_authors=args.authors, level=args.level,
+                                         sparse=args.sparse, stages=args.stages))
+    out = pd.concat(out, ignore_index=True)
+    out["sparse"] = args.sparse
+
+    if args.out is not None:
+        out.to_csv(args.out, mode="a", header=not os.path.exists(args.out), index=False)
+    return out
+
+
+if __name__ == "__main__":
+    print(main().to_string(index=False))
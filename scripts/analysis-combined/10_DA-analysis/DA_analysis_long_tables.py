@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+# Chunked reading of long (Sample, taxon, Abundance, metadata...) tables like the *-agg.csv files of
+# 00_TaxaAggregation.R, which repeat all sample metadata on every row.
+# The csv is read in blocks of rows with categorical sample and taxon columns. Only the nonzero counts (as row, column,
+# count triplets) and the first metadata of every sample and taxon are kept, so besides one block the memory used is
+# close to the size of the final count matrix.
+# Rows and columns come out sorted like raw.pivot(index=index, columns=columns, values=values); taxa with missing ranks
+# (dropna=False) are sorted last.
+
+chunk_rows = 500000
+
+
+def read_header(file_name):
+    # column names, without the unnamed index column written by R
+    cols = list(pd.read_csv(file_name, nrows=0).columns)
+    return cols[1:] if cols and (cols[0] == "" or cols[0].startswith("Unnamed")) else cols
+
+
+def iter_chunks(file_name, usecols, categorical=(), dtype=None, text=(), chunksize=None):
+    # text columns (metadata) are read as strings in every block: inferred per block, a column could be e.g. all-NaN
+    # floats in one block and strings in the next. parse_text converts the complete columns afterwards
+    dtype = dict(dtype or {})
+    for c in text:
+        dtype[c] = str
+    for c in categorical:
+        dtype[c] = "category"
+    return pd.read_csv(file_name, usecols=list(usecols), dtype=dtype, chunksize=chunksize or chunk_rows)
+
+
+bool_strings = {"True": True, "TRUE": True, "true": True, "False": False, "FALSE": False, "false": False}
+
+
+def parse_text(df):
+    # numeric and boolean columns from columns read as strings, like read_csv infers them for the whole file
+    df = df.copy()
+    for c in df.columns:
+        if df[c].dtype != object:
+            continue
+        try:
+            df[c] = pd.to_numeric(df[c])
+        except (ValueError, TypeError):
+            values = df[c].dropna()
+            if len(values) and len(values) == len(df[c]) and values.isin(list(bool_strings)).all():
+                df[c] = df[c].map(bool_strings)
+    return df
+
+
+def combined_codes(chunk, columns):
+    # one code per distinct combination of the categorical columns (missing values included), and the row of the
+    # first occurrence of every code
+    key = np.zeros(len(chunk), dtype=np.int64)
+    for c in columns:
+        codes = chunk[c].cat.codes.values.astype(np.int64) + 1
+        # re-compressed after every column, so the combined key never overflows
+        _, key = np.unique(key * (codes.max(initial=0) + 1) + codes, return_inverse=True)
+    _, first, key = np.unique(key, return_index=True, return_inverse=True)
+    return key, first
+
+
+def na_key(values):
+    # NaN != NaN, so missing values are stored as None in the lookup tables
+    return tuple([None if pd.isna(x) else x for x in values])
+
+
+class LongTable:
+    # counts and first metadata of a long table, updated with one block of rows at a time.
+    # index, columns: the row (sample) column and the column(s) that identify a taxon; both must be categorical in the
+    # blocks (see iter_chunks). meta_cols are taken per row, col_meta_cols per taxon, both the first non-missing value
+    # like groupby(...).first()
+    def __init__(self, index, columns, values="Abundance", meta_cols=(), col_meta_cols=(), dropna=False):
+        self.index = index
+        self.columns = [columns] if isinstance(columns, str) else list(columns)
+        self.values = values
+        self.meta_cols = list(meta_cols)
+        self.col_meta_cols = list(col_meta_cols)
+        self.dropna = dropna
+        self.row_ids = {}
+        self.col_ids = {}
+        self.rows = []
+        self.cols = []
+        self.counts = []
+        self.meta = []
+        self.col_meta = []
+
+    def update(self, chunk):
+        cat = chunk[self.index].cat
+        lookup = np.array([self.row_ids.setdefault(s, len(self.row_ids)) for s in cat.categories], dtype=np.int64)
+        rows = lookup[cat.codes.values]
+
+        key, first = combined_codes(chunk, self.columns)
+        taxa = chunk[self.columns].iloc[first].values
+        lookup = np.array([self.col_ids.setdefault(na_key(t), len(self.col_ids)) for t in taxa], dtype=np.int64)
+        cols = lookup[key]
+
+        keep = np.ones(len(chunk), dtype=bool)
+        if self.dropna:
+            keep &= chunk[self.columns].notna().all(axis=1).values
+        counts = chunk[self.values].values
+        keep &= counts != 0
+        self.rows.append(rows[keep].astype(np.int32))
+        self.cols.append(cols[keep].astype(np.int32))
+        self.counts.append(counts[keep])
+
+        if self.meta_cols:
+            m = chunk[self.meta_cols].groupby(rows, sort=False).first()
+            self.meta.append(m)
+        if self.col_meta_cols:
+            self.col_meta.append(chunk[self.col_meta_cols].groupby(cols, sort=False).first())
+        return self
+
+    def row_order(self):
+        names = np.array(list(self.row_ids), dtype=object)
+        order = np.argsort(names, kind="stable")
+        return order, pd.Index(names[order], name=self.index)
+
+    def col_order(self):
+        col_info = pd.DataFrame([[np.nan if x is None else x for x in t] for t in self.col_ids],
+                                columns=self.columns)
+        if self.dropna:
+            col_info = col_info.dropna()
+        order = col_info.sort_values(self.columns, na_position="last", kind="mergesort").index.values
+        return order, col_info.loc[order].reset_index(drop=True)
+
+    def matrix(self, sparse=False, dtype=None):
+        # (samples x taxa) counts; duplicated (sample, taxon) rows are summed
+        row_order, row_names = self.row_order()
+        col_order, col_info = self.col_order()
+        row_rank = np.empty(len(self.row_ids), dtype=np.int64)
+        row_rank[row_order] = np.arange(len(row_order))
+        # taxa dropped with dropna have no column
+        col_rank = np.full(len(self.col_ids), -1, dtype=np.int64)
+        col_rank[col_order] = np.arange(len(col_order))
+        shape = (len(row_order), len(col_order))
+        if dtype is None:
+            dtype = self.counts[0].dtype if self.counts else np.int64
+
+        if sparse:
+            X = sp.coo_matrix((np.concatenate(self.counts).astype(dtype, copy=False),
+                               (row_rank[np.concatenate(self.rows)], col_rank[np.concatenate(self.cols)])),
+                              shape=shape).tocsr()
+            X.eliminate_zeros()
+        else:
+            # preallocated; the triplets are added block by block
+            X = np.zeros(shape, dtype=dtype)
+            for r, c, v in zip(self.rows, self.cols, self.counts):
+                np.add.at(X, (row_rank[r], col_rank[c]), v)
+        return X, row_names, col_info
+
+    def metadata(self):
+        row_order, row_names = self.row_order()
+        if not self.meta:
+            return pd.DataFrame(index=row_names)
+        meta = pd.concat(self.meta).groupby(level=0).first()
+        meta = parse_text(meta.reindex(row_order))
+        meta.index = row_names
+        return meta
+
+    def col_metadata(self):
+        col_order, col_info = self.col_order()
+        if not self.col_meta:
+            return pd.DataFrame(index=col_info.index)
+        meta = pd.concat(self.col_meta).groupby(level=0).first()
+        return parse_text(meta.reindex(col_order).reset_index(drop=True))
+
+
+def read_long_table(file_name, index, columns, values="Abundance", meta_cols=(), col_meta_cols=(), sparse=False,
+                    dropna=False, count_dtype=np.int64, chunksize=None):
+    # counts (dense or CSR), row names, taxon columns and metadata of a long table, read in blocks of chunksize rows.
+    # Returns X, row_names, col_info, metadata, col_metadata
+    columns = [columns] if isinstance(columns, str) else list(columns)
+    table = LongTable(index, columns, values, meta_cols, col_meta_cols, dropna=dropna)
+    usecols = list(dict.fromkeys([index] + columns + [values] + list(meta_cols) + list(col_meta_cols)))
+    for chunk in iter_chunks(file_name, usecols, categorical=[index] + columns, dtype={values: count_dtype},
+                             text=list(meta_cols) + list(col_meta_cols), chunksize=chunksize):
+        table.update(chunk)
+    X, row_names, col_info = table.matrix(sparse=sparse, dtype=count_dtype)
+    return X, row_names, col_info, table.metadata(), table.col_metadata()
@@ -0,0 +1,76 @@
+import numpy as np
+import scipy.sparse as sp
+import anndata as ad
+
+# Normalization and pseudocounts for the DA models.
+# Every function returns a new AnnData and never writes into its input, which may be a view of a cached dataset.
+# The counts are processed in blocks of rows: for views only one block is materialized at a time, and besides the
+# result only temporaries of one block are allocated.
+
+block_rows = 4096
+
+
+def row_blocks(data, size=None):
+    size = size or block_rows
+    for r0 in range(0, data.n_obs, size):
+        r1 = min(r0 + size, data.n_obs)
+        yield slice(r0, r1), data[r0:r1].X
+
+
+def with_counts(data, X):
+    # new AnnData with the same samples and taxa
+    return ad.AnnData(X=X, obs=data.obs.copy(), var=data.var.copy())
+
+
+def row_index(X):
+    # row of every stored entry of a CSR matrix
+    return np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+
+
+def closure(data, size=None):
+    # relative abundances (rows sum to 1)
+    return scale_rows(data, 1., round_counts=False, size=size)
+
+
+def scale_to_total(data, total, size=None):
+    # counts rescaled to `total` reads per sample and rounded, like
+    # np.round(X / np.sum(X, axis=1, keepdims=True) * total, 0).astype(int)
+    return scale_rows(data, total, round_counts=True, size=size)
+
+
+def scale_rows(data, total, round_counts=True, size=None):
+    dtype = int if round_counts else float
+    if sp.issparse(data.X):
+        blocks = []
+        for _, X in row_blocks(data, size):
+            X = sp.csr_matrix(X)
+            sums = np.asarray(X.sum(axis=1), dtype=float).ravel()
+            # only the stored entries are scaled; same operation order as the dense version
+            x = X.data / sums[row_index(X)]
+            x *= total
+            if round_counts:
+                np.round(x, 0, out=x)
+            X = sp.csr_matrix((x.astype(dtype), X.indices.copy(), X.indptr.copy()), shape=X.shape)
+            X.eliminate_zeros()
+            blocks.append(X)
+        return with_counts(data, sp.vstack(blocks, format="csr") if blocks else sp.csr_matrix(data.shape, dtype=dtype))
+
+    out = np.empty(data.shape, dtype=dtype)
+    for rows, X in row_blocks(data, size):
+        x = np.divide(X, np.sum(X, axis=1, keepdims=True), dtype=float)
+        x *= total
+        if round_counts:
+            np.round(x, 0, out=x)
+        out[rows] = x
+    return with_counts(data, out)
+
+
+def replace_zeros(data, value=0.5, size=None):
+    # dense float counts with all zeros replaced by a pseudocount, without a mask of the whole matrix
+    out = np.empty(data.shape, dtype=float)
+    for rows, X in row_blocks(data, size):
+        x = out[rows]
+        x[...] = X.toarray() if sp.issparse(X) else X
+        x[x == 0] = value
+    return with_counts(data, out)
+
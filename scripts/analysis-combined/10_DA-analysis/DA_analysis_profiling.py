@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import cProfile
+import subprocess
+from contextlib import contextmanager
+
+# Per-stage wall time, CPU time and peak RSS of DA runs.
+#
+# Library code marks its stages with `with stage("read_csv", ...) as rec:`; the yielded dict takes extra fields,
+# e.g. data shapes. Stages are only recorded inside `profiled(out_file)`, which writes them as json lines to
+# {out_file without .csv}.profile.jsonl next to the result csv.
+#
+# DA_PROFILE=cprofile additionally writes a cProfile dump ({...}.prof, for pstats/snakeviz),
+# DA_PROFILE=py-spy attaches `py-spy record` to the process and writes a speedscope file ({...}.speedscope.json).
+
+# finished stages of the runs that are being profiled, and the stages that are open
+records = []
+open_stages = []
+active = [0]
+
+
+def peak_rss_mb():
+    # VmHWM on Linux (can be reset per stage), otherwise the peak of the whole process
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+@contextmanager
+def stage(name, **info):
+    if not active[0]:
+        yield dict(info)
+        return
+
+    # the peak of an enclosing stage includes the peaks of its inner stages, as peak RSS is reset for every stage
+    if open_stages:
+        open_stages[-1]["peak"] = max(open_stages[-1]["peak"], peak_rss_mb())
+    reset_peak_rss()
+
+    rec = dict(stage=".".join([s["name"] for s in open_stages] + [name]), **info)
+    open_stages.append({"name": name, "peak": 0.})
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield rec
+    finally:
+        rec["wall_s"] = round(time.perf_counter() - wall, 4)
+        rec["cpu_s"] = round(time.process_time() - cpu, 4)
+        peak = max(open_stages.pop()["peak"], peak_rss_mb())
+        rec["peak_rss_mb"] = round(peak, 1)
+        if open_stages:
+            open_stages[-1]["peak"] = max(open_stages[-1]["peak"], peak)
+        records.append(rec)
+
+
+def profile_stem(out_file):
+    return out_file[:-4] if out_file.endswith(".csv") else out_file
+
+
+def start_py_spy(out_file):
+    try:
+        return subprocess.Popen(["py-spy", "record", "--pid", str(os.getpid()), "--format", "speedscope",
+                                 "-o", out_file], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        print("py-spy not found, no sampling profile is written")
+        return None
+
+
+def stop_py_spy(p):
+    # py-spy writes its output when it is interrupted
+    if p is not None:
+        p.send_signal(signal.SIGINT)
+        try:
+            p.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+@contextmanager
+def profiled(out_file, profiler=None, **meta):
+    # records all stages of the enclosed run and appends them to the profile of out_file. meta (e.g. the job) is added
+    # to every line
+    if profiler is None:
+        profiler = os.environ.get("DA_PROFILE")
+    stem = profile_stem(out_file)
+
+    start = len(records)
+    active[0] += 1
+    prof = cProfile.Profile() if profiler == "cprofile" else None
+    spy = start_py_spy(f"{stem}.speedscope.json") if profiler == "py-spy" else None
+    if prof is not None:
+        prof.enable()
+    try:
+        with stage("run"):
+            yield
+    finally:
+        if prof is not None:
+            prof.disable()
+            prof.dump_stats(f"{stem}.prof")
+        stop_py_spy(spy)
+        active[0] -= 1
+
+        run_records = records[start:]
+        del records[start:]
+        os.makedirs(os.path.dirname(stem) or ".", exist_ok=True)
+        with open(f"{stem}.profile.jsonl", "a") as f:
+            for rec in run_records:
+                f.write(json.dumps(dict(meta, host=socket.gethostname(), pid=os.getpid(), **rec), default=str) + "\n")
+
+
+def read_profile(out_file):
+    import pandas as pd
+    with open(f"{profile_stem(out_file)}.profile.jsonl") as f:
+        return pd.DataFrame([json.loads(line) for line in f])
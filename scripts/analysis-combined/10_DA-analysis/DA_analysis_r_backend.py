@@ -0,0 +1,169 @@
+import numpy as np
+import scipy.sparse as sp
+import pandas as pd
+
+# R packages and wrapper functions are loaded once per process and reused by every model fit
+r_packages = {}
+r_functions = {}
+
+ancombc_defaults = {
+    "p_adj_method": "fdr",
+    "zero_cut": 1,
+    "lib_cut": 0,
+    "struc_zero": True,
+    "neg_lb": True,
+    "tol": 1e-5,
+}
+
+# counts arrive as a numeric matrix (samples x taxa), so nothing is serialized to R source text
+ancombc_r_code = """
+function(counts, taxa, group, covariate, p_adj_method, zero_cut, lib_cut, struc_zero, neg_lb, tol, alpha) {
+    sample_ids = as.character(seq_len(nrow(counts)) - 1)
+    dimnames(counts) = list(sample_ids, taxa)
+
+    sample = data.frame(group, row.names = sample_ids)
+    colnames(sample) = covariate
+
+    OTU = otu_table(t(counts), taxa_are_rows = TRUE)
+
+    #create phyloseq data object
+    data = phyloseq(OTU, sample_data(sample))
+
+    ancombc(phyloseq = data,
+            formula = covariate,
+            p_adj_method = p_adj_method,
+            zero_cut = zero_cut,
+            lib_cut = lib_cut,
+            group = covariate,
+            struc_zero = struc_zero,
+            neg_lb = neg_lb,
+            tol = tol,
+            max_iter = 100,
+            conserve = TRUE,
+            alpha = alpha,
+            global = FALSE
+            )
+}
+"""
+
+linda_r_code = """
+function(otus, taxa, samples, meta, formula, alpha) {
+    dimnames(otus) = list(taxa, samples)
+    linda(otus, meta, formula = formula, alpha = alpha, prev.cut = 0, lib.cut = 1)
+}
+"""
+
+
+def load_r_packages(packages):
+    import rpy2.robjects as rp
+
+    for p in packages:
+        if p not in r_packages:
+            rp.r(f"suppressPackageStartupMessages(library({p}))")
+            r_packages[p] = True
+
+
+def r_function(name):
+    import rpy2.robjects as rp
+
+    if name not in r_functions:
+        if name == "ancombc":
+            load_r_packages(["ANCOMBC", "phyloseq"])
+            r_functions[name] = rp.r(ancombc_r_code)
+        elif name == "linda":
+            load_r_packages(["LinDA"])
+            r_functions[name] = rp.r(linda_r_code)
+        else:
+            raise ValueError(f"Unknown R function: {name}!")
+    return r_functions[name]
+
+
+def warm_up(models=("ancombc", "linda")):
+    # can be used as initializer of a process pool, so workers start with R and all packages loaded
+    for m in models:
+        r_function(m)
+
+
+def r_conversion():
+    # numpy and pandas conversion only while a model is fitted and its results are parsed,
+    # instead of activating numpy2ri/pandas2ri for the whole process
+    import rpy2.robjects as rp
+    from rpy2.robjects import numpy2ri, pandas2ri
+    from rpy2.robjects.conversion import localconverter
+
+    return localconverter(rp.default_converter + numpy2ri.converter + pandas2ri.converter)
+
+
+def count_matrix(data):
+    # the R models need dense matrices, so sparse counts are only densified here
+    if sp.issparse(data.X):
+        return data.X.toarray().astype(float)
+    return np.asarray(data.X, dtype=float)
+
+
+def parse_ancombc(out_, var_index):
+    x = pd.DataFrame(np.array(out_[1]))
+    x.columns = ["struc_zero_0", "struc_zero_1"]
+    x.index = list(out_[1].names[0])
+    df = pd.DataFrame(dict(zip(out_[6].names, [[y[0] for y in x] for x in out_[6]])))
+    df.index = list(out_[1].names[0])
+
+    df = df.merge(x, right_index=True, left_index=True)
+
+    out = df
+    out.index = var_index
+    out["is_da"] = [True if x == 1 else False for x in out["diff_abn"]]
+
+    return out
+
+
+def fit_ancombc(datasets, alpha=0.05, covariate_column="host_disease", **kwargs):
+    import rpy2.robjects as rp
+    from rpy2.robjects import numpy2ri
+
+    fit = r_function("ancombc")
+    params = dict(ancombc_defaults, **kwargs)
+
+    out = []
+    with r_conversion():
+        for data in datasets:
+            out_ = fit(
+                numpy2ri.py2rpy(count_matrix(data)),
+                rp.StrVector(list(data.var.index)),
+                rp.StrVector([str(x) for x in data.obs[covariate_column]]),
+                covariate_column,
+                params["p_adj_method"],
+                params["zero_cut"],
+                params["lib_cut"],
+                params["struc_zero"],
+                params["neg_lb"],
+                params["tol"],
+                alpha,
+            )
+            out.append(parse_ancombc(out_, data.var.index))
+
+    return out
+
+
+def fit_linda(datasets, alpha=0.05, formula="host_disease"):
+    import rpy2.robjects as rp
+    from rpy2.robjects import numpy2ri, pandas2ri
+
+    fit = r_function("linda")
+
+    out = []
+    with r_conversion():
+        for data in datasets:
+            lo = fit(
+                numpy2ri.py2rpy(count_matrix(data).T),
+                rp.StrVector(list(data.var.index)),
+                rp.StrVector(list(data.obs.index)),
+                pandas2ri.py2rpy(data.obs),
+                f"~{formula}",
+                alpha,
+            )
+            res = pd.DataFrame(lo[2][0])
+            res.index = data.var.index
+            out.append(res)
+
+    return out
@@ -0,0 +1,151 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+import DA_analysis_util_functions as util
+
+tax_levels = util.tax_levels
+ref_levels = ["Phylum", "Class", "Order", "Family", "Genus"]
+authors = ["Fukui", "Hugerth", "Labus", "LoPresti", "Nagel", "Pozuelo", "Zeber", "Zhu", "Zhuang", "Liu", "AGP"]
+
+# reference taxa should not come from the large phyla that are often differentially abundant themselves
+excluded_taxa = ["Bacteria*Firmicutes", "Bacteria*Bacteroidota"]
+
+
+def stool_samples(data, author):
+    # samples used for reference finding (see sccoda_reference_finding.ipynb)
+    keep = (data.obs["sample_type"] == "stool").values
+    if author == "Pozuelo":
+        keep &= (data.obs["Collection"] == "1st").values
+    return data[keep]
+
+
+def iter_datasets(authors, level, data_dir, cache_dir=None, finest=None):
+    # one sparse dataset at a time, so only a single dataset is in memory
+    for a in authors:
+        data = util.agg_ibs_data(a, level, data_dir, cache_dir=cache_dir, sparse=True, finest=finest)
+        yield a, stool_samples(data, a)
+
+
+class RefStats:
+    # per-taxon statistics over datasets, updated with one dataset at a time.
+    # Only the per-dataset presence and dispersion vectors (with taxon row indices) are kept, not the counts.
+    # They form a (taxa x datasets) matrix for medians and extremes; a taxon that is missing from a dataset is NaN there
+    def __init__(self, abundant_threshold=0.75):
+        self.abundant_threshold = abundant_threshold
+        self.taxa = {}
+        self.authors = []
+        self.rows = []
+        self.cols = []
+        self.presence = []
+        self.dispersion = []
+
+    def update(self, data, author):
+        X = data.X if sp.issparse(data.X) else sp.csr_matrix(data.X)
+        # samples without counts have no relative abundances
+        X = X[np.asarray(X.sum(axis=1)).ravel() > 0]
+        if X.shape[0] == 0:
+            print(f"{author}: no samples with counts, skipped")
+            return self
+        percent_zero, disp = util.taxon_stats(X)
+
+        col = len(self.authors)
+        self.authors.append(author)
+        self.rows.append(np.array([self.taxa.setdefault(t, len(self.taxa)) for t in data.var.index]))
+        self.cols.append(np.full(data.n_vars, col))
+        self.presence.append(1 - percent_zero)
+        self.dispersion.append(disp)
+        return self
+
+    def matrix(self, values):
+        rows = np.concatenate(self.rows)
+        cols = np.concatenate(self.cols)
+        m = np.full((len(self.taxa), len(self.authors)), np.nan)
+        m[rows, cols] = np.concatenate(values)
+        return m
+
+    def summary(self):
+        presence = self.matrix(self.presence)
+        disp = self.matrix(self.dispersion)
+        with np.errstate(invalid="ignore"):
+            is_abundant = np.where(np.isnan(presence), np.nan, presence > self.abundant_threshold)
+
+        with warnings.catch_warnings():
+            # all-NaN dispersion for taxa that are never observed
+            warnings.simplefilter("ignore", RuntimeWarning)
+            df = pd.DataFrame({
+                "n_abundant": np.nansum(is_abundant, axis=1).astype(int),
+                "n_datasets": np.sum(~np.isnan(presence), axis=1),
+                "dispersion_mean": np.nanmean(disp, axis=1),
+                "dispersion_median": np.nanmedian(disp, axis=1),
+                "dispersion_min": np.nanmin(disp, axis=1),
+                "dispersion_max": np.nanmax(disp, axis=1),
+                "presence_min": np.nanmin(presence, axis=1),
+                "presence_median": np.nanmedian(presence, axis=1),
+            }, index=pd.Index(list(self.taxa), name="Cell Type"))
+        return df
+
+    def per_dataset(self):
+        # long table like get_ref_stats in the notebook
+        presence = self.matrix(self.presence)
+        disp = self.matrix(self.dispersion)
+        taxa = np.array(list(self.taxa), dtype=object)
+        df = pd.DataFrame({
+            "Cell Type": np.repeat(taxa, len(self.authors)),
+            "Author": np.tile(self.authors, len(taxa)),
+            "Total dispersion": disp.ravel(),
+            "Presence": presence.ravel(),
+        })
+        return df[df["Presence"].notna()].reset_index(drop=True)
+
+
+def rank_candidates(summary, n_datasets=None, excluded=excluded_taxa, min_presence=0., min_median_presence=0.25):
+    # candidates are in every dataset, have no excluded ancestor, are present in at least min_presence of the samples
+    # in every dataset and in min_median_presence of the samples in a typical dataset (median). They are ranked by their
+    # worst (maximal) dispersion and median presence over the datasets, i.e. a good reference has low dispersion
+    # everywhere and is not rare in most datasets
+    if n_datasets is None:
+        n_datasets = summary["n_datasets"].max()
+
+    keep = (summary["n_datasets"] == n_datasets) & (summary["presence_min"] >= min_presence) & \
+        (summary["presence_median"] >= min_median_presence)
+    for e in excluded:
+        keep &= ~((summary.index == e) | summary.index.str.startswith(e + "*"))
+
+    cand = summary[keep].copy()
+    cand["score"] = (cand["dispersion_max"].rank(ascending=True) + cand["presence_median"].rank(ascending=False)) / 2
+    cand = cand.sort_values(["score", "dispersion_max"])
+    cand["rank"] = np.arange(1, len(cand) + 1)
+    return cand
+
+
+def find_references(data_dir, authors=authors, levels=ref_levels, abundant_threshold=0.75, cache_dir=None,
+                    finest=None, **kwargs):
+    # ranked reference candidates for every level, from statistics that are accumulated over all authors' datasets.
+    # kwargs go to rank_candidates
+    out = {}
+    for l in levels:
+        stats = RefStats(abundant_threshold)
+        for a, data in iter_datasets(authors, l, data_dir, cache_dir=cache_dir, finest=finest):
+            stats.update(data, a)
+        out[l] = rank_candidates(stats.summary(), n_datasets=len(stats.authors), **kwargs)
+    return out
+
+
+def lineage_references(taxon, levels=ref_levels):
+    # reference taxa on all coarser levels: the ancestors of `taxon`, like the references of run_sccoda
+    names = taxon.split("*")
+    return dict([(l, "*".join(names[:tax_levels.index(l) + 1])) for l in levels if tax_levels.index(l) < len(names)])
+
+
+def consistent_references(candidates, levels=ref_levels):
+    # best-ranked taxon of the finest level whose ancestors are candidates on every coarser level.
+    # Returns a {level: reference} dict or None
+    finest = levels[-1]
+    for taxon in candidates[finest].index:
+        refs = lineage_references(taxon, levels)
+        if all([refs[l] in candidates[l].index for l in levels]):
+            return refs
+    return None
@@ -0,0 +1,191 @@
+import os
+import math
+import multiprocessing as mp
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from DA_analysis_scheduler import thread_env_vars, set_thread_caps, restore_env, default_n_workers
+
+# Memory and runtime guardrails for scCODA runs on large cohorts (e.g. AGP).
+#
+# Before sampling, memory and runtime of sample_hmc are estimated from the number of samples N, taxa K and the chain
+# length. Memory is dominated by get_y_hat and make_result, which keep concentrations and predictions of every
+# draw (draws x N x K floats, about four copies at the peak). Runtime grows with N * K per leapfrog step.
+# plan_sccoda checks the estimate against a Budget and, if it does not fit, shortens the chain (down to min_results)
+# or fits the model on n_subsets stratified subsets with the same number of Healthy and IBS samples each. The subsets
+# are sampled in parallel processes and their effects combined by combine_effects.
+
+# Budget(mem_gb, hours) of one run; None = no limit
+Budget = namedtuple("Budget", ["mem_gb", "hours"], defaults=[None, None])
+
+# measured with sccoda 0.1.7 / TF 2.9 on one core (peak RSS and wall time of sample_hmc, 100-400 samples x 20-80 taxa)
+cost_model = {
+    "base_mb": 800.,       # python, TF and the compiled sampler
+    "nk_copies": 4.,       # float64 (N x K) arrays per post-burn-in draw
+    "step_s": 4.5e-3,      # per HMC step, plus
+    "step_nk_s": 3.3e-6,   # per HMC step and N * K (10 leapfrog steps)
+}
+
+Estimate = namedtuple("Estimate", ["mem_gb", "hours"])
+
+
+def estimate_sccoda(n_samples, n_taxa, num_results=int(20e3), num_burnin=int(5e3), num_leapfrog_steps=10, n_covariates=1,
+                    cost=None):
+    cost = dict(cost_model, **(cost or {}))
+    draws = num_results - num_burnin
+    nk = n_samples * n_taxa
+    # traced states: sigma_d, b_offset, ind_raw (covariates x taxa) and alpha of every step
+    n_params = n_covariates * (2 * n_taxa + 1) + n_taxa
+    mem = cost["base_mb"] * 2**20 + 8 * (cost["nk_copies"] * draws * nk + 2 * num_results * n_params)
+    step = (cost["step_s"] + cost["step_nk_s"] * n_covariates * nk) * num_leapfrog_steps / 10
+    return Estimate(mem / 2**30, num_results * step / 3600)
+
+
+def fits(estimate, budget, n_parallel=1, n_rounds=1):
+    # n_parallel runs at the same time share the memory, n_rounds of them run one after the other
+    return (budget.mem_gb is None or n_parallel * estimate.mem_gb <= budget.mem_gb) and \
+        (budget.hours is None or n_rounds * estimate.hours <= budget.hours)
+
+
+def budget_from_env():
+    # DA_MEM_GB / DA_HOURS; None (no budget, every run as requested) without any of them. The budget is opt-in: the
+    # memory of a SLURM job is deliberately not used, as downscaled runs give different results
+    mem = os.environ.get("DA_MEM_GB")
+    hours = os.environ.get("DA_HOURS")
+    if mem is None and hours is None:
+        return None
+    return Budget(None if mem is None else float(mem), None if hours is None else float(hours))
+
+
+def plan_sccoda(n_samples, n_taxa, budget, sampler_kwargs=None, on_exceed="downscale", min_results=int(10e3),
+                n_subsets=5, n_workers=None, min_group=20, n_groups=2, n_covariates=1, cost=None):
+    # how to run scCODA on (n_samples x n_taxa) data within budget, as a dict with
+    #   mode: "full" (as requested), "shortened" (shorter chain) or "subsampled" (n_subsets subsets of max_samples
+    #         samples, n_parallel at a time),
+    #   sampler_kwargs for sample_hmc, and the estimate of one run.
+    # on_exceed="refuse" raises instead of downscaling, like a plan that does not fit even with subsets of
+    # min_group samples per group
+    sampler_kwargs = dict(sampler_kwargs or {})
+    num_results = sampler_kwargs.get("num_results", int(20e3))
+    num_burnin = sampler_kwargs.get("num_burnin", int(5e3))
+    leapfrog = sampler_kwargs.get("num_leapfrog_steps", 10)
+
+    def est(n, r):
+        return estimate_sccoda(n, n_taxa, r, num_burnin, leapfrog, n_covariates, cost)
+
+    plan = dict(mode="full", n_samples=n_samples, n_taxa=n_taxa, sampler_kwargs=sampler_kwargs,
+                estimate=est(n_samples, num_results))
+    if budget is None or fits(plan["estimate"], budget):
+        return plan
+    if on_exceed == "refuse":
+        raise RuntimeError(f"scCODA on {n_samples} samples x {n_taxa} taxa needs about "
+                           f"{plan['estimate'].mem_gb:.1f} GB and {plan['estimate'].hours:.1f} h, budget is {budget}!")
+    if on_exceed != "downscale":
+        raise ValueError(f"Invalid on_exceed: {on_exceed}!")
+
+    # shorter chain: memory and time shrink with the number of draws
+    shortest = max(min(min_results, num_results), num_burnin + 1)
+    if fits(est(n_samples, shortest), budget):
+        r = shortest
+        while r < num_results and fits(est(n_samples, r + 1000), budget):
+            r += 1000
+        r = min(r, num_results)
+        return dict(plan, mode="shortened", sampler_kwargs=dict(sampler_kwargs, num_results=r),
+                    estimate=est(n_samples, r))
+
+    # subsets with the full chain: the most samples per subset that fit, over all numbers of subsets run at the same
+    # time (more in parallel share the memory, fewer take more rounds)
+    if n_workers is None:
+        n_workers = default_n_workers()
+
+    def largest_subset(n_parallel):
+        n_rounds = math.ceil(n_subsets / n_parallel)
+        lo, hi = 0, n_samples
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if fits(est(mid, num_results), budget, n_parallel, n_rounds):
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo - lo % n_groups
+
+    max_samples, n_parallel = max((largest_subset(n), n) for n in range(1, max(1, min(n_workers, n_subsets)) + 1))
+    if max_samples < n_groups * min_group:
+        raise RuntimeError(f"scCODA on {n_samples} samples x {n_taxa} taxa does not fit into {budget}, not even with "
+                           f"subsets of {min_group} samples per group!")
+    return dict(plan, mode="subsampled", max_samples=max_samples, n_subsets=n_subsets, n_parallel=n_parallel,
+                estimate=est(max_samples, num_results))
+
+
+def describe_plan(plan):
+    if plan["mode"] == "shortened":
+        return f"shortened (num_results={plan['sampler_kwargs']['num_results']})"
+    if plan["mode"] == "subsampled":
+        return f"subsampled ({plan['n_subsets']} subsets of {plan['max_samples']} samples)"
+    return plan["mode"]
+
+
+def mark_downscaled(effect_df, plan):
+    # downscaled runs are marked in their result ("Sampling" column), so they are not mistaken for full runs
+    if plan["mode"] != "full":
+        effect_df["Sampling"] = describe_plan(plan)
+    return effect_df
+
+
+def stratified_subsets(groups, n_subsets, max_samples, seed=0):
+    # positions of n_subsets subsets with the same number of samples from every group (at most max_samples in total,
+    # at most the size of the smallest group per group). Every group is shuffled once and the subsets take consecutive
+    # slices of it (wrapping around), so all samples are used about equally often
+    groups = pd.Series(np.asarray(groups, dtype=object))
+    idx = [np.flatnonzero(groups.values == g) for g in pd.unique(groups)]
+    per_group = min(max_samples // len(idx), min(len(i) for i in idx))
+    rng = np.random.default_rng(seed)
+    perms = [rng.permutation(i) for i in idx]
+    subsets = []
+    for s in range(n_subsets):
+        take = [np.take(p, np.arange(s * per_group, (s + 1) * per_group), mode="wrap") for p in perms]
+        subsets.append(np.sort(np.concatenate(take)))
+    return subsets
+
+
+def subset_effects(data, formula, reference, fdr_level, sampler_kwargs):
+    import sccoda.util.comp_ana as mod
+    model = mod.CompositionalAnalysis(data=data, formula=formula, reference_cell_type=reference)
+    result = model.sample_hmc(**sampler_kwargs)
+    return result.summary_prepare(est_fdr=fdr_level)[1]
+
+
+def combine_effects(effects, min_agreement=0.5):
+    # one effect_df from the effect_dfs of all subsets: means of all columns and the fraction of subsets in which an
+    # effect is credible ("Credible fraction"). "Final Parameter" is the mean over the subsets where it is credible,
+    # if that is at least min_agreement of them, otherwise 0
+    stacked = pd.concat(effects, keys=range(len(effects)))
+    combined = stacked.groupby(level=list(range(1, stacked.index.nlevels)), sort=False).mean()
+    credible = (stacked["Final Parameter"] != 0).groupby(level=list(range(1, stacked.index.nlevels)), sort=False)
+    frac = credible.mean()
+    final = stacked["Final Parameter"].where(stacked["Final Parameter"] != 0) \
+        .groupby(level=list(range(1, stacked.index.nlevels)), sort=False).mean()
+    combined["Final Parameter"] = final.where(frac >= min_agreement, 0.).fillna(0.)
+    combined["Credible fraction"] = frac
+    return combined.reindex(effects[0].index)
+
+
+def run_subsampled(data, formula, reference, fdr_level, plan, group="host_disease", seed=0, threads_per_job=1,
+                   min_agreement=0.5):
+    # plan from plan_sccoda (mode "subsampled"). The subsets are fitted in plan["n_parallel"] spawned processes
+    # with capped thread pools, each on a copy of its subset only
+    subsets = stratified_subsets(data.obs[group], plan["n_subsets"], plan["max_samples"], seed=seed)
+
+    old_env = dict((v, os.environ.get(v)) for v in thread_env_vars)
+    set_thread_caps(threads_per_job)
+    try:
+        with ProcessPoolExecutor(max_workers=plan["n_parallel"], mp_context=mp.get_context("spawn")) as pool:
+            futures = [pool.submit(subset_effects, data[s].copy(), formula, reference, fdr_level,
+                                   plan["sampler_kwargs"]) for s in subsets]
+            effects = [f.result() for f in futures]
+    finally:
+        restore_env(old_env)
+    return combine_effects(effects, min_agreement=min_agreement)
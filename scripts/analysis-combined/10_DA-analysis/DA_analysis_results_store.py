@@ -0,0 +1,177 @@
+import os
+import re
+import io
+import json
+import zlib
+import sqlite3
+
+import pandas as pd
+
+tax_levels = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus"]
+methods = ["sccoda", "ANCOMBC", "LinDA"]
+
+# one row per result table, keyed by (author, level, add, method, alpha, run_no).
+# The table itself is stored as compressed csv text, so reading it back gives exactly what pd.read_csv gives for the file
+schema = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    author TEXT NOT NULL,
+    level TEXT NOT NULL,
+    add_ TEXT,
+    method TEXT NOT NULL,
+    alpha REAL,
+    run_no TEXT,
+    file TEXT,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_query ON results (method, level, author, alpha, run_no);
+"""
+
+key_cols = ["author", "level", "add_", "method", "alpha", "run_no"]
+
+
+def connect(store_file):
+    os.makedirs(os.path.dirname(store_file) or ".", exist_ok=True)
+    # several processes may write to the same store, wait for their locks instead of failing
+    con = sqlite3.connect(store_file, timeout=60)
+    con.executescript(schema)
+    return con
+
+
+def result_key(author, level, add, method, alpha, run_no):
+    return json.dumps([author, level, add, method, alpha, run_no])
+
+
+def normalize(author, level, add, method, alpha, run_no):
+    level = level.capitalize()
+    alpha = None if alpha is None else float(alpha)
+    run_no = None if run_no is None else str(run_no)
+    return author, level, add, method, alpha, run_no
+
+
+def insert_result(store_file, values, file_name, data):
+    con = connect(store_file)
+    try:
+        with con:
+            con.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (result_key(*values),) + values + (file_name, zlib.compress(data))
+            )
+    finally:
+        con.close()
+
+
+def add_result_file(store_file, author, level, add, method, alpha, run_no, file_name):
+    with open(file_name, "rb") as f:
+        data = f.read()
+    insert_result(store_file, normalize(author, level, add, method, alpha, run_no), os.path.abspath(file_name), data)
+
+
+def add_result(store_file, author, level, add, method, alpha, run_no, res):
+    insert_result(store_file, normalize(author, level, add, method, alpha, run_no), None, res.to_csv().encode())
+
+
+def merge_stores(store_file, shard_files):
+    # copy all results of other stores (e.g. one per SLURM array task) into store_file. Returns the number of rows copied
+    con = connect(store_file)
+    n = 0
+    try:
+        for f in shard_files:
+            # make sure the shard has the results table, even if its task did not finish any job
+            connect(f).close()
+            con.execute("ATTACH DATABASE ? AS shard", (f,))
+            try:
+                with con:
+                    n += con.execute("INSERT OR REPLACE INTO results SELECT * FROM shard.results").rowcount
+            finally:
+                con.execute("DETACH DATABASE shard")
+    finally:
+        con.close()
+    return n
+
+
+def result_file_pattern(levels=tax_levels[1:], methods=methods):
+    # {author}_{level}[_{add}]_{method}[_alpha_{alpha}][_{run_no}].csv, as written by the runners
+    return re.compile(
+        r"^(?P<author>[^_]+)_(?P<level>" + "|".join([l.lower() for l in levels]) + r")_"
+        r"(?:(?P<add>.+?)_)?(?P<method>" + "|".join(methods) + r")"
+        r"(?:_alpha_(?P<alpha>[0-9.]+?))?(?:_(?P<run_no>[^_]+))?\.csv$"
+    )
+
+
+def import_result_files(store_file, data_dir, methods=methods):
+    # index existing result directories ({data_dir}/{Author}-{year}/*.csv) into the store
+    pattern = result_file_pattern(methods=methods)
+    n = 0
+    for subdir_name in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, subdir_name)
+        if not os.path.isdir(path) or "-" not in subdir_name:
+            continue
+        author = subdir_name.split("-")[0]
+        for f in sorted(os.listdir(path)):
+            m = pattern.match(f)
+            if m is None or m["author"] != author.lower():
+                continue
+            add_result_file(store_file, author, m["level"], m["add"], m["method"], m["alpha"], m["run_no"],
+                            os.path.join(path, f))
+            n += 1
+    return n
+
+
+def where_clause(conditions):
+    # None -> IS NULL, list -> IN (...), anything else -> equality
+    sql = []
+    params = []
+    for col, v in conditions.items():
+        if v is None:
+            sql.append(f"{col} IS NULL")
+        elif isinstance(v, (list, tuple, set)):
+            v = list(v)
+            nulls = [x for x in v if x is None]
+            v = [x for x in v if x is not None]
+            terms = []
+            if v:
+                terms.append(f"{col} IN ({', '.join(['?'] * len(v))})")
+                params += v
+            if nulls:
+                terms.append(f"{col} IS NULL")
+            sql.append("(" + " OR ".join(terms) + ")" if terms else "0")
+        else:
+            sql.append(f"{col} = ?")
+            params.append(v)
+    return (" WHERE " + " AND ".join(sql) if sql else ""), params
+
+
+def prepare_conditions(conditions):
+    conditions = dict(conditions)
+    if "add" in conditions:
+        conditions["add_"] = conditions.pop("add")
+    for col, f in [("level", str.capitalize), ("alpha", float), ("run_no", str)]:
+        v = conditions.get(col)
+        if isinstance(v, (list, tuple, set)):
+            conditions[col] = [None if x is None else f(x) for x in v]
+        elif v is not None:
+            conditions[col] = f(v)
+    return where_clause(conditions)
+
+
+def query_results(store_file, **conditions):
+    # conditions on author, level, add, method, alpha and run_no; omitted columns are not filtered.
+    # Returns a list of (author, level, add, method, alpha, run_no, result table)
+    sql, params = prepare_conditions(conditions)
+    con = connect(store_file)
+    try:
+        rows = con.execute(f"SELECT {', '.join(key_cols)}, data FROM results{sql}", params).fetchall()
+    finally:
+        con.close()
+
+    return [row[:-1] + (pd.read_csv(io.BytesIO(zlib.decompress(row[-1])), index_col=0),) for row in rows]
+
+
+def list_results(store_file, **conditions):
+    sql, params = prepare_conditions(conditions)
+    con = connect(store_file)
+    try:
+        return pd.read_sql_query(f"SELECT {', '.join(key_cols)}, file FROM results{sql}", con, params=params)
+    finally:
+        con.close()
@@ -0,0 +1,310 @@
+import os
+import time
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+
+from DA_analysis_scheduler import thread_env_vars, set_thread_caps
+
+
+def hmc_results(pkr):
+    # innermost Metropolis-Hastings results, independent of the kernel wrappers used
+    while not hasattr(pkr, "accepted_results"):
+        pkr = pkr.inner_results
+    return pkr
+
+
+def trace_fn(_, pkr):
+    # same diagnostics as CompositionalModel.sample_hmc
+    r = hmc_results(pkr)
+    step_size = r.accepted_results.step_size
+    # one step size for all state parts
+    if isinstance(step_size, (list, tuple)):
+        step_size = step_size[0]
+    return {
+        "target_log_prob": r.accepted_results.target_log_prob,
+        "diverging": (r.log_accept_ratio < -1000.),
+        "is_accepted": r.is_accepted,
+        "step_size": step_size,
+    }
+
+
+def hmc_kernel(model, step_size, num_leapfrog_steps=10, num_adapt_steps=None):
+    import tensorflow_probability as tfp
+
+    kernel = tfp.mcmc.HamiltonianMonteCarlo(
+        target_log_prob_fn=model.target_log_prob_fn,
+        step_size=step_size,
+        num_leapfrog_steps=num_leapfrog_steps,
+        store_parameters_in_results=True)
+    kernel = tfp.mcmc.TransformedTransitionKernel(inner_kernel=kernel, bijector=model.constraining_bijectors)
+    if num_adapt_steps:
+        kernel = tfp.mcmc.SimpleStepSizeAdaptation(
+            inner_kernel=kernel, num_adaptation_steps=num_adapt_steps, target_accept_prob=0.75)
+    return kernel
+
+
+def chain_worker(conn, data, formula, reference_cell_type, seed, num_burnin, segment, num_leapfrog_steps, step_size):
+    # one MCMC chain: burn-in with step size adaptation, then segments of `segment` draws on request of the parent
+    try:
+        import tensorflow as tf
+        import tensorflow_probability as tfp
+        import sccoda.util.comp_ana as mod
+
+        tf.random.set_seed(seed)
+        model = mod.CompositionalAnalysis(data=data, formula=formula, reference_cell_type=reference_cell_type)
+
+        def make_sampler(kernel, n):
+            @tf.function(autograph=False)
+            def sample(state):
+                return tfp.mcmc.sample_chain(num_results=n, num_burnin_steps=0, kernel=kernel, current_state=state,
+                                             trace_fn=trace_fn)
+            return sample
+
+        start = time.time()
+        kernel = hmc_kernel(model, step_size, num_leapfrog_steps, num_adapt_steps=int(0.8 * num_burnin))
+        states, stats = make_sampler(kernel, num_burnin)(model.init_params)
+        state = [s[-1] for s in states]
+
+        # after adaptation, the step size stays fixed
+        sample = make_sampler(hmc_kernel(model, float(stats["step_size"][-1]), num_leapfrog_steps), segment)
+        conn.send(("burnin", time.time() - start))
+
+        while conn.recv():
+            states, stats = sample(state)
+            state = [s[-1] for s in states]
+            conn.send(("draws", ([s.numpy() for s in states], dict([(k, v.numpy()) for k, v in stats.items()]))))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def inclusion_indicators(states):
+    # |beta| > 1e-3 for all non-reference effects, like the inclusion probabilities of CAResult.complete_beta_df
+    sigma_d, b_offset, ind_raw = states[0], states[1], states[2]
+    ind = 1 / (1 + np.exp(-50 * ind_raw))
+    return (np.abs(ind * sigma_d * b_offset) > 1e-3).astype(float)
+
+
+def convergence_stats(x):
+    # x: (chain, draw, ...). Rank-normalized split R-hat and bulk ESS for every parameter
+    import arviz as az
+
+    ds = az.convert_to_dataset(x)
+    rhat = np.asarray(az.rhat(ds)["x"])
+    ess = np.asarray(az.ess(ds, method="bulk")["x"])
+
+    # parameters that are constant within every chain have no R-hat/ESS; they have converged if all chains agree
+    chain_means = x.mean(axis=1)
+    agree = np.ptp(chain_means, axis=0) == 0
+    rhat = np.where(np.isnan(rhat), np.where(agree, 1., np.inf), rhat)
+    ess = np.where(np.isnan(ess), np.where(agree, np.inf, 0.), ess)
+    return rhat, ess
+
+
+def sample_hmc_parallel(data, formula, reference_cell_type, n_chains=4, num_results=int(20e3), num_burnin=int(5e3),
+                        max_draws=None, segment=500, rhat_max=1.01, ess_min=400, num_leapfrog_steps=10,
+                        step_size=0.01, threads_per_chain=1, seed=0, verbose=True):
+    # Runs n_chains HMC chains of the scCODA model in separate processes. After every segment of draws,
+    # R-hat and ESS of the effect inclusion indicators and intercepts are checked, and sampling stops once they converged
+    # or max_draws (default: num_results - num_burnin, the post-burn-in length of one sample_hmc chain) draws are pooled.
+    # Returns a CAResult of the pooled draws, so summary_prepare uses all chains.
+    import sccoda.util.comp_ana as mod
+
+    if max_draws is None:
+        max_draws = num_results - num_burnin
+    max_segments = max(1, int(np.ceil(max_draws / (n_chains * segment))))
+
+    if data.is_view:
+        data = data.copy()
+
+    # chains are spawned with capped thread pools, so n_chains * threads_per_chain cores are used
+    ctx = mp.get_context("spawn")
+    old_env = dict((v, os.environ.get(v)) for v in thread_env_vars)
+    set_thread_caps(threads_per_chain)
+
+    conns = []
+    procs = []
+    try:
+        for c in range(n_chains):
+            parent_conn, child_conn = ctx.Pipe()
+            p = ctx.Process(target=chain_worker, args=(child_conn, data, formula, reference_cell_type, seed + c,
+                                                       num_burnin, segment, num_leapfrog_steps, step_size))
+            p.start()
+            child_conn.close()
+            conns.append(parent_conn)
+            procs.append(p)
+    finally:
+        for v, x in old_env.items():
+            if x is None:
+                os.environ.pop(v, None)
+            else:
+                os.environ[v] = x
+
+    def receive(conn):
+        kind, msg = conn.recv()
+        if kind == "error":
+            raise RuntimeError(f"MCMC chain failed:\n{msg}")
+        return msg
+
+    start = time.time()
+    draws = [[] for _ in range(n_chains)]
+    stats = [[] for _ in range(n_chains)]
+    try:
+        for conn in conns:
+            receive(conn)
+        if verbose:
+            print(f"Burn-in finished. ({time.time() - start:.3f} sec)")
+
+        for i in range(max_segments):
+            for conn in conns:
+                conn.send(True)
+            for c, conn in enumerate(conns):
+                s, st = receive(conn)
+                draws[c].append(s)
+                stats[c].append(st)
+
+            chains = [[np.concatenate(x) for x in zip(*d)] for d in draws]
+            x = np.stack([np.concatenate([inclusion_indicators(s).reshape(len(s[0]), -1), s[3]], axis=1)
+                          for s in chains])
+            rhat, ess = convergence_stats(x)
+            converged = np.max(rhat) <= rhat_max and np.min(ess) >= ess_min
+            if verbose:
+                print(f"{x.shape[1]} draws per chain: max R-hat {np.max(rhat):.4f}, min ESS {np.min(ess):.0f}")
+            if converged:
+                break
+        for conn in conns:
+            conn.send(False)
+    finally:
+        for conn in conns:
+            conn.close()
+        for p in procs:
+            p.join(timeout=60)
+            if p.is_alive():
+                p.terminate()
+    duration = time.time() - start
+
+    # pooled draws as one chain, which is what CAResult.summary_prepare evaluates
+    states = [np.concatenate([c[j] for c in chains]) for j in range(len(chains[0]))]
+    sample_stats = dict([(k, np.concatenate([np.concatenate([s[k] for s in st]) for st in stats]))
+                         for k in stats[0][0].keys()])
+    n_draws = len(states[0])
+    acc_rate = np.mean(sample_stats["is_accepted"])
+
+    model = mod.CompositionalAnalysis(data=data, formula=formula, reference_cell_type=reference_cell_type)
+    y_hat = model.get_y_hat(states, n_draws, 0)
+
+    sampling_stats = {"chain_length": num_burnin + n_draws // n_chains, "num_burnin": num_burnin,
+                      "acc_rate": acc_rate, "duration": duration, "y_hat": y_hat,
+                      "n_chains": n_chains, "converged": converged, "max_rhat": np.max(rhat), "min_ess": np.min(ess)}
+    return model.make_result(states, sample_stats, sampling_stats)
+
+
+def reference_columns(K, reference):
+    # for every cell type, its column among the K-1 non-reference effects, or column K-1 (zeros) for the reference
+    return [k if k < reference else (K - 1 if k == reference else k - 1) for k in range(K)]
+
+
+def batched_log_prob_fn(model, references):
+    # joint log density of the scCODA model (CompositionalAnalysis.target_log_prob_fn) for a batch of reference
+    # cell types (indices). State parts have a leading reference dimension R:
+    # sigma_d [R, D, 1], b_offset and ind_raw [R, D, K-1], alpha [R, K]. Returns log densities of shape [R]
+    import tensorflow as tf
+    import tensorflow_probability as tfp
+    tfd = tfp.distributions
+
+    dtype = tf.float64
+    columns = tf.constant([reference_columns(model.K, r) for r in references])
+    x = model.x
+    y = tf.cast(model.y, dtype)
+    n_total = tf.cast(model.n_total, dtype)
+    zero = tf.constant(0., dtype)
+    one = tf.constant(1., dtype)
+
+    @tf.function(jit_compile=True)
+    def target_log_prob_fn(sigma_d, b_offset, ind_raw, alpha):
+        lp = tf.reduce_sum(tfd.HalfCauchy(zero, one).log_prob(sigma_d), axis=[1, 2])
+        lp += tf.reduce_sum(tfd.Normal(zero, one).log_prob(b_offset), axis=[1, 2])
+        lp += tf.reduce_sum(tfd.Normal(zero, one).log_prob(ind_raw), axis=[1, 2])
+        lp += tf.reduce_sum(tfd.Normal(zero, one * 5).log_prob(alpha), axis=1)
+
+        ind_scaled = ind_raw * 50
+        ind = tf.exp(ind_scaled) / (1 + tf.exp(ind_scaled))
+        beta = ind * (sigma_d * b_offset)
+        # zero effect of every model's reference at its position
+        beta = tf.concat([beta, tf.zeros_like(beta[:, :, :1])], axis=2)
+        beta = tf.gather(beta, columns, axis=2, batch_dims=1)
+
+        concentrations = tf.exp(alpha[:, None, :] + tf.einsum("nd,rdk->rnk", x, beta))
+        lp += tf.reduce_sum(tfd.DirichletMultinomial(n_total, concentrations).log_prob(y), axis=1)
+        return lp
+
+    return target_log_prob_fn
+
+
+def sample_hmc_batched(data, formula, references, num_results=int(20e3), num_burnin=int(5e3), num_leapfrog_steps=10,
+                       step_size=0.01, verbose=True):
+    # HMC for several reference cell types in one run. The models only differ in the position of the zero effect,
+    # so their chains are sampled as a batch of one vectorized log density, and every chain adapts its own step size.
+    # num_results steps per chain, of which the first num_burnin (with step size adaptation) are discarded, so the
+    # num_results - num_burnin draws per reference are those of CompositionalAnalysis.sample_hmc and chain_worker.
+    # Returns {reference: CAResult}, each like the result of sample_hmc for that reference
+    import tensorflow as tf
+    import tensorflow_probability as tfp
+    import sccoda.util.comp_ana as mod
+
+    if data.is_view:
+        data = data.copy()
+
+    models = [mod.CompositionalAnalysis(data=data, formula=formula, reference_cell_type=r) for r in references]
+    model = models[0]
+    n_refs = len(models)
+    dtype = tf.float64
+
+    init = [
+        tf.ones([n_refs, model.D, 1], dtype),
+        tf.random.normal([n_refs, model.D, model.K - 1], 0, 1, dtype),
+        tf.zeros([n_refs, model.D, model.K - 1], dtype),
+        tf.random.normal([n_refs, model.K], 0, 1, dtype),
+    ]
+    # one step size per chain, broadcast over its state parts
+    step_sizes = [tf.fill([n_refs] + [1] * (len(s.shape) - 1), tf.constant(step_size, dtype)) for s in init]
+
+    kernel = tfp.mcmc.HamiltonianMonteCarlo(
+        target_log_prob_fn=batched_log_prob_fn(model, [m.reference_cell_type for m in models]),
+        step_size=step_sizes,
+        num_leapfrog_steps=num_leapfrog_steps,
+        store_parameters_in_results=True)
+    kernel = tfp.mcmc.SimpleStepSizeAdaptation(
+        inner_kernel=kernel, num_adaptation_steps=int(0.8 * num_burnin), target_accept_prob=0.75)
+
+    # burn-in is traced and cut below, as in chain_worker
+    @tf.function(autograph=False)
+    def sample(state):
+        return tfp.mcmc.sample_chain(num_results=num_results, num_burnin_steps=0, kernel=kernel,
+                                     current_state=state, trace_fn=trace_fn)
+
+    start = time.time()
+    states, stats = sample(init)
+    duration = time.time() - start
+    if verbose:
+        print(f"MCMC sampling of {n_refs} references finished. ({duration:.3f} sec)")
+
+    states = [s.numpy() for s in states]
+    stats = dict([(k, v.numpy()) for k, v in stats.items()])
+    results = {}
+    for i, (r, m) in enumerate(zip(references, models)):
+        # chain of one reference after burn-in, like get_chains_after_burnin
+        states_r = [s[num_burnin:, i] for s in states]
+        sample_stats = dict([(k, v[num_burnin:, i].reshape(num_results - num_burnin)) for k, v in stats.items()])
+        acc_rate = np.mean(sample_stats["is_accepted"])
+        if verbose:
+            print(f"{r}: acceptance rate {100 * acc_rate:.1f}%")
+
+        y_hat = m.get_y_hat(states_r, num_results, num_burnin)
+        sampling_stats = {"chain_length": num_results, "num_burnin": num_burnin, "acc_rate": acc_rate,
+                          "duration": duration, "y_hat": y_hat, "n_references": n_refs}
+        results[r] = m.make_result(states_r, sample_stats, sampling_stats)
+    return results
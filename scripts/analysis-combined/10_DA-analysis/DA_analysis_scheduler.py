@@ -0,0 +1,217 @@
+import os
+import json
+import itertools
+import traceback
+import multiprocessing as mp
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# environment variables that cap the thread pools of TensorFlow and the BLAS/OpenMP backends
+thread_env_vars = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+    "TF_NUM_INTEROP_THREADS",
+]
+
+Job = namedtuple("Job", ["author", "level", "add", "model", "alpha", "run_no"])
+
+
+def run_sccoda_job(author, level, data_dir, add=None, alpha=0.1, **kwargs):
+    import DA_analysis_util_functions as util
+    return util.run_sccoda(author, level, data_dir, add=add, fdr_level=alpha, **kwargs)
+
+
+def run_ancombc_job(author, level, data_dir, add=None, alpha=0.05, **kwargs):
+    import DA_analysis_util_functions as util
+    return util.run_ancombc_model(author, level, data_dir, add=add, alpha=alpha, **kwargs)
+
+
+def run_linda_job(author, level, data_dir, add=None, alpha=0.05, **kwargs):
+    import DA_analysis_util_functions as util
+    return util.run_linda_model(author, level, data_dir, add=add, alpha=alpha, **kwargs)
+
+
+default_runners = {
+    "sccoda": run_sccoda_job,
+    "ANCOMBC": run_ancombc_job,
+    "LinDA": run_linda_job,
+}
+
+
+def expand_grid(author_adds, levels, models, alphas, run_nos=(None,)):
+    jobs = []
+    for (author, adds), l, m, alpha, run_no in itertools.product(author_adds.items(), levels, models, alphas, run_nos):
+        for a in adds:
+            jobs.append(Job(author, l, a, m, alpha, run_no))
+    return jobs
+
+
+def job_filename(job, save_dir, subdirs=None):
+    # same naming scheme as one_author_new
+    filename = f"{job.author.lower()}_{job.level.lower()}_"
+    if job.add is not None:
+        filename += f"{job.add[1]}_"
+    filename += f"{job.model}_alpha_{job.alpha}"
+    if job.run_no:
+        filename += f"_{job.run_no}"
+
+    if subdirs is not None:
+        save_dir = os.path.join(save_dir, subdirs[job.author])
+    return os.path.join(save_dir, filename + ".csv")
+
+
+def set_thread_caps(n_threads):
+    for v in thread_env_vars:
+        os.environ[v] = str(n_threads)
+
+
+def restore_env(old_env):
+    for v, x in old_env.items():
+        if x is None:
+            os.environ.pop(v, None)
+        else:
+            os.environ[v] = x
+
+
+def default_n_workers(threads_per_job=1):
+    n_cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count() or 1))
+    return max(1, n_cpus // threads_per_job)
+
+
+def job_key(job):
+    add = None if job.add is None else list(job.add)
+    return json.dumps([job.author, job.level, add, job.model, job.alpha, job.run_no])
+
+
+def read_manifest(manifest_file):
+    done = {}
+    if manifest_file is None or not os.path.exists(manifest_file):
+        return done
+
+    with open(manifest_file) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # last line of a manifest that was cut off mid-write
+                continue
+            done[entry["key"]] = entry["file"]
+    return done
+
+
+def write_manifest_entry(manifest_file, job, out_file):
+    os.makedirs(os.path.dirname(manifest_file) or ".", exist_ok=True)
+    with open(manifest_file, "a") as f:
+        f.write(json.dumps({"key": job_key(job), "file": out_file}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def is_done(job, out_file, manifest):
+    # without a manifest, an existing output file counts as finished
+    if not os.path.exists(out_file):
+        return False
+    if manifest is None:
+        return True
+    return manifest.get(job_key(job)) == out_file
+
+
+def run_job(job, runner, data_dir, out_file, run_kwargs):
+    import DA_analysis_profiling as prof
+
+    # stage times and memory go to {out_file without .csv}.profile.jsonl
+    with prof.profiled(out_file, job=job_key(job)):
+        out = runner(job.author, job.level, data_dir, add=job.add, alpha=job.alpha, **run_kwargs)
+
+        # write to a temporary file first, so a job killed while writing never leaves a complete-looking csv
+        with prof.stage("write_csv", shape=out.shape):
+            os.makedirs(os.path.dirname(out_file) or ".", exist_ok=True)
+            tmp_file = f"{out_file}.{os.getpid()}.tmp"
+            out.to_csv(tmp_file)
+            os.replace(tmp_file, out_file)
+    return out_file
+
+
+def run_grid(jobs, data_dir, save_dir, subdirs=None, runners=None, n_workers=None, threads_per_job=1, run_kwargs=None,
+             manifest_file=None, skip_done=True, initializer=None, store_file=None):
+    if runners is None:
+        runners = default_runners
+    if run_kwargs is None:
+        run_kwargs = {}
+    if n_workers is None:
+        n_workers = default_n_workers(threads_per_job)
+
+    for job in jobs:
+        if job.model not in runners:
+            raise ValueError(f"Invalid model name: {job.model}!")
+
+    results = {}
+
+    # skip jobs finished by an earlier (interrupted) sweep
+    out_files = dict([(job, job_filename(job, save_dir, subdirs)) for job in jobs])
+    if skip_done:
+        manifest = read_manifest(manifest_file) if manifest_file is not None else None
+        todo = []
+        for job in jobs:
+            if is_done(job, out_files[job], manifest):
+                results[job] = out_files[job]
+            else:
+                todo.append(job)
+        print(f"{len(jobs) - len(todo)} of {len(jobs)} jobs already done")
+        jobs = todo
+
+    def finish(job, out_file):
+        results[job] = out_file
+        # results are added to the store from this process only, so there is a single writer
+        if store_file is not None:
+            import DA_analysis_results_store as rs
+            rs.add_result_file(store_file, job.author, job.level, None if job.add is None else job.add[1], job.model,
+                               job.alpha, job.run_no, out_file)
+        if manifest_file is not None:
+            write_manifest_entry(manifest_file, job, out_file)
+
+    old_env = dict((v, os.environ.get(v)) for v in thread_env_vars)
+
+    # single worker: run in this process, which keeps tracebacks and debuggers usable. The thread caps only reach
+    # backends that are not loaded yet (e.g. TF, imported by the first scCODA run), and are undone afterwards
+    if n_workers == 1:
+        set_thread_caps(threads_per_job)
+        try:
+            if initializer is not None:
+                initializer()
+            for job in jobs:
+                print(job)
+                try:
+                    finish(job, run_job(job, runners[job.model], data_dir, out_files[job], run_kwargs))
+                except Exception as e:
+                    traceback.print_exc()
+                    results[job] = e
+        finally:
+            restore_env(old_env)
+        return results
+
+    # spawned workers start from a clean interpreter and inherit the environment, so the thread caps
+    # are in place before numpy/TF initialize their thread pools
+    set_thread_caps(threads_per_job)
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context("spawn"), initializer=initializer) as pool:
+            futures = {
+                pool.submit(run_job, job, runners[job.model], data_dir, out_files[job], run_kwargs): job
+                for job in jobs
+            }
+            for f in as_completed(futures):
+                job = futures[f]
+                try:
+                    finish(job, f.result())
+                    print(f"Done: {job}")
+                except Exception as e:
+                    print(f"Failed: {job}: {e!r}")
+                    results[job] = e
+    finally:
+        restore_env(old_env)
+
+    return results
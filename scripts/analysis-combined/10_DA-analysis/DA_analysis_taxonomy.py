@@ -0,0 +1,91 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+tax_levels = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus"]
+
+# Integer IDs for '*'-joined lineages ("Bacteria*Firmicutes*...").
+# Every lineage is registered (and split into its levels) only once per process; tables then carry int32 IDs and
+# categorical taxonomy columns instead of one Python string per row and level.
+
+
+class TaxonomyRegistry:
+    # lineage <-> ID, and for every ID the codes of its names on every level. The categories of a level only grow,
+    # so codes stay valid when new lineages are added
+    def __init__(self, levels=tax_levels, sep="*"):
+        self.levels = list(levels)
+        self.sep = sep
+        self.lineages = pd.Index([], dtype=object)
+        self.categories = [pd.Index([], dtype=object) for _ in self.levels]
+        self.codes = np.empty((0, len(self.levels)), dtype=np.int32)
+        # result files are formatted in several threads (see read_results in the util functions)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.lineages)
+
+    def add(self, names):
+        split = pd.Series(names, dtype=object).str.split(self.sep, expand=True)
+        split = split.reindex(columns=range(len(self.levels)))
+        codes = np.empty((len(names), len(self.levels)), dtype=np.int32)
+        for i in range(len(self.levels)):
+            col = split[i]
+            new = pd.Index(pd.unique(col.dropna())).difference(self.categories[i], sort=False)
+            self.categories[i] = self.categories[i].append(new)
+            codes[:, i] = self.categories[i].get_indexer(col)
+        self.lineages = self.lineages.append(pd.Index(names, dtype=object))
+        self.codes = np.concatenate([self.codes, codes])
+
+    def ids(self, names):
+        # int32 ID of every lineage (-1 for missing names); unknown lineages are registered
+        names = pd.Index(names, dtype=object)
+        with self.lock:
+            ids = self.lineages.get_indexer(names)
+            new = (ids < 0) & names.notna()
+            if new.any():
+                self.add(pd.unique(names[new]))
+                ids = self.lineages.get_indexer(names)
+        return ids.astype(np.int32)
+
+    def names(self, ids):
+        ids = np.asarray(ids)
+        out = self.lineages.take(np.where(ids < 0, 0, ids)) if len(self) else pd.Index([None] * len(ids), dtype=object)
+        return out.where(ids >= 0)
+
+    def table(self, ids, n_levels=None, categorical=True):
+        # one column per level (all levels; the ones below n_levels are empty).
+        # Categorical columns share the categories of the registry, so tables built from it concatenate without copies
+        if n_levels is None:
+            n_levels = len(self.levels)
+        ids = np.asarray(ids)
+        if len(self):
+            codes = np.where((ids >= 0)[:, None], self.codes[np.where(ids >= 0, ids, 0)], -1)
+        else:
+            codes = np.full((len(ids), len(self.levels)), -1, dtype=np.int32)
+        cols = {}
+        for i, l in enumerate(self.levels):
+            c = codes[:, i] if i < n_levels else np.full(len(ids), -1, dtype=np.int32)
+            cat = pd.Categorical.from_codes(c, categories=self.categories[i])
+            cols[l] = cat if categorical else np.asarray(cat.astype(object))
+        tax_table = pd.DataFrame(cols)
+        if not categorical:
+            # empty levels are NaN floats
+            tax_table = tax_table.infer_objects()
+        return tax_table
+
+
+# shared by data loading and the result readers
+registry = TaxonomyRegistry()
+
+
+def categorical_metadata(metadata):
+    # string columns with repeated values (host_disease, sample_type, author, ...) as categoricals, by the same rule as
+    # anndata uses when writing h5ad files, so freshly loaded and cached datasets have the same dtypes
+    metadata = metadata.copy()
+    for c in metadata.columns:
+        col = metadata[c]
+        if col.dtype == object and pd.api.types.infer_dtype(col, skipna=True) == "string" and \
+                col.nunique(dropna=True) < len(col):
+            metadata[c] = col.astype("category")
+    return metadata
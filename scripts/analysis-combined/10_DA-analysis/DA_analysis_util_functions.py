@@ -1,19 +1,20 @@
 import os
+import json
+import pickle
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import anndata as ad
 import numpy as np
-import toytree as tt
-import toyplot
-import toyplot.color
+import scipy.sparse as sp
 
-import sccoda.util.comp_ana as mod
-import sccoda.model.other_models as om
-
-from rpy2.robjects import numpy2ri, pandas2ri
-import rpy2.robjects as rp
-numpy2ri.activate()
-pandas2ri.activate()
-import rpy2.robjects.packages as rpackages
+# the R backend imports rpy2 (and starts R) only when a model is fitted
+import DA_analysis_r_backend as rb
+import DA_analysis_profiling as prof
+import DA_analysis_preprocessing as pp
+import DA_analysis_long_tables as lt
+import DA_analysis_taxonomy as tx
 
 r_home = "/Library/Frameworks/R.framework/Resources" # CHANGE THIS DIRECTORY ON YOUR COMPUTER
 r_path = r"/Library/Frameworks/R.framework/Resources/bin" # CHANGE THIS DIRECTORY ON YOUR COMPUTER
@@ -21,150 +22,419 @@ r_path = r"/Library/Frameworks/R.framework/Resources/bin" # CHANGE THIS DIRECTOR
 os.environ["R_HOME"] = r_home
 os.environ["PATH"] = r_path + ";" + os.environ["PATH"]
 
+# sccoda.util.comp_ana, imported on first use by sccoda_module(). Importing it loads TensorFlow,
+# which data loading and result evaluation do not need
+mod = None
+
 tax_levels = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus"]
 
 
-def agg_ibs_data(author, level, data_dir):
+def join_taxonomy(tax_table, sep="*"):
+    # vectorized version of tax_table.apply('*'.join, axis=1)
+    cols = [tax_table[c] for c in tax_table.columns]
+    if len(cols) == 1:
+        return cols[0].copy()
+    return cols[0].str.cat(cols[1:], sep=sep)
+
+
+def clean_taxon_names(names):
+    names = pd.Index(names).str.replace("(", "", regex=False).str.replace(")", "", regex=False)
+    return names.rename(None)
+
+
+def agg_cache_path(file_name, cache_dir, variant=None):
+    # cache entries are keyed by the csv name, size and modification time, so edited tables are rebuilt
+    st = os.stat(file_name)
+    key = hashlib.md5(f"{os.path.abspath(file_name)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    if variant is not None:
+        stem += f"_{variant}"
+    return os.path.join(cache_dir, f"{stem}_{key}.h5ad")
+
+
+def write_agg_cache(data, cache_file):
+    cache_dir, base = os.path.split(cache_file)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # drop entries built from older versions of the same csv
+    stem = base.rsplit("_", 1)[0]
+    for f in os.listdir(cache_dir):
+        if f.startswith(stem + "_") and f.endswith(".h5ad") and f != base and "_" not in f[len(stem) + 1:]:
+            try:
+                os.remove(os.path.join(cache_dir, f))
+            except FileNotFoundError:
+                pass
+
+    # write to a temporary file first, so parallel readers never see a half-written entry
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    data.write_h5ad(tmp_file)
+    os.replace(tmp_file, cache_file)
+
+
+def densify(data):
+    # for models that strictly need a dense count matrix
+    if sp.issparse(data.X):
+        return ad.AnnData(X=data.X.toarray(), obs=data.obs, var=data.var)
+    return data
+
+
+def taxon_stats(X):
+    # fraction of zero counts and dispersion (variance/mean) of the relative abundances for every taxon
+    n = X.shape[0]
+    if sp.issparse(X):
+        X = sp.csr_matrix(X, dtype=float)
+        X.eliminate_zeros()
+        rel_abun = sp.diags(1 / np.asarray(X.sum(axis=1)).ravel()) @ X
+        mean = np.asarray(rel_abun.mean(axis=0)).ravel()
+        var = np.asarray(rel_abun.multiply(rel_abun).mean(axis=0)).ravel() - mean ** 2
+        percent_zero = (n - X.getnnz(axis=0)) / n
+    else:
+        X = np.asarray(X)
+        rel_abun = X / np.sum(X, axis=1, keepdims=True)
+        mean = np.mean(rel_abun, axis=0)
+        var = np.var(rel_abun, axis=0)
+        percent_zero = np.sum(X == 0, axis=0) / n
+
+    return percent_zero, var / mean
+
+
+def aggregate_taxa(data, level):
+    # counts of a finer-level dataset summed up to `level` with a sparse (taxa x groups) indicator matrix.
+    # Taxa without assignment on `level` are dropped, like in tax_glom
+    tl = tax_levels[:tax_levels.index(level) + 1]
+    grouped = data.var.groupby(tl, sort=False, observed=True)
+    cols = grouped.ngroup()
+    keep = (cols.notna() & (cols >= 0)).values
+    tax_info = grouped.size().index.to_frame(index=False)
+
+    G = sp.csr_matrix(
+        (np.ones(keep.sum(), dtype=data.X.dtype), (np.flatnonzero(keep), cols.values[keep].astype(int))),
+        shape=(data.n_vars, len(tax_info))
+    )
+    X = data.X @ G
+    X = X.tocsr() if sp.issparse(X) else np.asarray(X)
+
+    tax_info = tax_info.astype(object)
+    tax_info.index = clean_taxon_names(join_taxonomy(tax_info))
+    return ad.AnnData(X=X, obs=data.obs.copy(), var=tax_info)
+
+
+def agg_ibs_data(author, level, data_dir, cache_dir=None, sparse=False, table=None, finest=None):
+    # table: read {author}_{table}-agg.csv instead of the table of `level`.
+    # finest: name of a genus-level table, e.g. "genus-all" from 00_TaxaAggregation.R, which also keeps taxa without genus
+    # assignment. Every level is then summed up from this table, which is read only once per process (see prepared_data)
+    if finest is not None:
+        fine = prepared_data(author, "Genus", data_dir, cache_dir=cache_dir, sparse=sparse, table=finest)
+        with prof.stage("aggregate_taxa") as rec:
+            ret = aggregate_taxa(fine, level)
+            rec["shape"] = ret.shape
+        return ret
 
     # read data
     subdir_name = [x for x in os.listdir(data_dir) if x.startswith(author+"-")][0]
-    file_name = data_dir + subdir_name + f"/{author.lower()}_{level.lower()}-agg.csv"
-    raw_data = pd.read_csv(file_name, index_col=0)
+    file_name = data_dir + subdir_name + f"/{author.lower()}_{(table or level).lower()}-agg.csv"
+
+    # binary fast path: reuse the AnnData built from an unchanged csv
+    if cache_dir is not None:
+        cache_file = agg_cache_path(file_name, cache_dir, variant="sparse" if sparse else None)
+        if os.path.exists(cache_file):
+            with prof.stage("read_cache") as rec:
+                ret = ad.read_h5ad(cache_file)
+                rec["shape"] = ret.shape
+            return ret
 
     # get taxonomic levels in the data
     tl = [x for x in tax_levels[:tax_levels.index(level) + 1]]
 
-    # extract counts
-    count_data = raw_data.pivot(index="Sample", columns=tl, values="Abundance")
-    # get taxonomic tree (for data.var)
-    tax_info = pd.DataFrame(index=count_data.columns).reset_index()
-    tax_index = tax_info.apply('*'.join, axis=1)
-    tax_index = [s.replace("(", "") .replace(")", "") for s in tax_index]
-    tax_info.index = tax_index
+    # the long table is read in blocks straight into the count matrix; metadata is the first value of every sample
+    with prof.stage("read_csv", sparse=sparse) as rec:
+        metadata_cols = [c for c in lt.read_header(file_name) if c not in ["Sample", "Abundance"] + tax_levels]
+        count_data, _, tax_info, metadata, _ = lt.read_long_table(file_name, "Sample", tl, "Abundance",
+                                                                  meta_cols=metadata_cols, sparse=sparse)
+        rec["shape"] = count_data.shape
 
-    count_data.columns = tax_index
+    # taxa without assignment on some rank only occur in tables aggregated with NArm=FALSE; they are kept as NaN
+    has_na = tax_info.isna().any().any()
+    tax_info.index = clean_taxon_names(join_taxonomy(tax_info.fillna("NA") if has_na else tax_info))
 
-    # get metadata
-    metadata_cols = raw_data.columns.drop(["Sample", "Abundance"] + tax_levels, errors="ignore")
-    metadata = raw_data.groupby("Sample").agg(dict([(x, "first") for x in metadata_cols]))
+    with prof.stage("anndata"):
+        ret = ad.AnnData(X=count_data, obs=tx.categorical_metadata(metadata), var=tax_info)
+
+    if cache_dir is not None:
+        with prof.stage("write_cache"):
+            write_agg_cache(ret, cache_file)
 
-    ret = ad.AnnData(X=count_data, obs=metadata, var=tax_info)
     return ret
 
 
-def run_sccoda(author, level, data_dir, add=None, fdr_level=0.1,):
-    references = {
-        "Genus": "Bacteria*Proteobacteria*Gammaproteobacteria*Burkholderiales*Sutterellaceae*Parasutterella",
-        "Family": "Bacteria*Proteobacteria*Gammaproteobacteria*Burkholderiales*Sutterellaceae",
-        "Order": "Bacteria*Proteobacteria*Gammaproteobacteria*Burkholderiales",
-        "Class": "Bacteria*Proteobacteria*Gammaproteobacteria",
-        "Phylum": "Bacteria*Proteobacteria",
-    }
+# in-process LRU cache of loaded datasets: all models, alphas and sample groups of one (author, level) run on views of
+# the same object. Size is bounded by data_cache_max_bytes
+data_cache = OrderedDict()
+data_cache_max_bytes = 4 * 2**30
 
-    data = agg_ibs_data(author, level, data_dir)
-    if add is not None:
-        data = data[data.obs[add[0]] == add[1]]
 
-    model = mod.CompositionalAnalysis(
-        data=data,
-        formula="C(host_disease, Treatment('Healthy'))",
-        reference_cell_type=references[level]
-    )
-    result = model.sample_hmc()
-    _, effect_df = result.summary_prepare(est_fdr = fdr_level)
+def data_nbytes(data):
+    X = data.X
+    if sp.issparse(X):
+        n = X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    else:
+        n = np.asarray(X).nbytes
+    return n + data.obs.memory_usage(deep=True).sum() + data.var.memory_usage(deep=True).sum()
 
-    return effect_df
 
+def freeze(data):
+    # cached counts are read-only, so in-place changes have to go through a copy (anndata copies views on write)
+    X = data.X
+    for a in ([X.data, X.indices, X.indptr] if sp.issparse(X) else [X]):
+        a.setflags(write=False)
+    return data
 
-def run_ancombc_model(author, level, data_dir, add=None, alpha=0.05):
-    data = agg_ibs_data(author, level, data_dir)
-    if add is not None:
-        data = data[data.obs[add[0]] == add[1]]
-
-    data.X[data.X == 0] = 0.5
-    ac = om.ANCOMBCModel(data.copy(), covariate_column="host_disease")
-
-    abc_full_dict = {
-        "p_adj_method": "fdr",
-        "zero_cut": 1,
-        "lib_cut": 0,
-        "struc_zero": "TRUE",
-        "neg_lb": "TRUE",
-        "tol": 1e-5
-    }
-
-    out_ = rp.r(f"""
-                    library(ANCOMBC)
-                    library(phyloseq)
-
-                    #prepare phyloseq data format
-
-                    counts = {pandas2ri.py2rpy_pandasdataframe(pd.DataFrame(ac.y, columns=ac.var.index)).r_repr()}
-
-                    sample = {pandas2ri.py2rpy_pandasdataframe(pd.DataFrame(ac.x,
-                                                                            columns=[ac.covariate_column])).r_repr()}
-
-                    cell_types = colnames(counts)
-
-                    OTU = otu_table(t(counts), taxa_are_rows = TRUE)
-
-                    #create phyloseq data object
-                    data = phyloseq(OTU, sample_data(sample))
-
-                    ancombc_out = ancombc(phyloseq = data,
-                                          formula = "{ac.covariate_column}",
-                                          p_adj_method = "{abc_full_dict["p_adj_method"]}",
-                                          zero_cut = {abc_full_dict["zero_cut"]},
-                                          lib_cut = {abc_full_dict["lib_cut"]},
-                                          group = "{ac.covariate_column}",
-                                          struc_zero = {abc_full_dict["struc_zero"]},
-                                          neg_lb = {abc_full_dict["neg_lb"]},
-                                          tol = {abc_full_dict["tol"]},
-                                          max_iter = 100,
-                                          conserve = TRUE,
-                                          alpha = {alpha},
-                                          global = FALSE
-                                          )
-
-                    out = ancombc_out
-                    out
-                    """)
-    x = pd.DataFrame(np.array(out_[1]))
-    x.columns = ["struc_zero_0", "struc_zero_1"]
-    x.index = list(out_[1].names[0])
-    df = pd.DataFrame(dict(zip(out_[6].names, [[y[0] for y in x] for x in out_[6]])))
-    df.index = list(out_[1].names[0])
-
-    df = df.merge(x, right_index=True, left_index=True)
-
-    # df["zero_ind"] = zero_ind
-    out = df
-    out.index = data.var.index
-    out["is_da"] = [True if x == 1 else False for x in out["diff_abn"]]
 
-    return out
+def clear_data_cache():
+    data_cache.clear()
 
 
-def run_linda_model(author, level, data_dir, add=None, alpha=0.05, formula="host_disease"):
-    data = agg_ibs_data(author, level, data_dir)
-    if add is not None:
-        data = data[data.obs[add[0]] == add[1]]
+def prepared_data(author, level, data_dir, add=None, cache_dir=None, sparse=False, table=None, finest=None):
+    key = (author, level, os.path.abspath(data_dir), cache_dir, sparse, table, finest)
+
+    if key in data_cache:
+        data_cache.move_to_end(key)
+        data, _ = data_cache[key]
+    else:
+        with prof.stage("load"):
+            data = freeze(agg_ibs_data(author, level, data_dir, cache_dir=cache_dir, sparse=sparse, table=table,
+                                       finest=finest))
+        data_cache[key] = (data, data_nbytes(data))
+
+        # evict least recently used datasets, but always keep the newest one
+        while len(data_cache) > 1 and sum([n for _, n in data_cache.values()]) > data_cache_max_bytes:
+            data_cache.popitem(last=False)
+
+    # always a view, never the cached object itself
+    with prof.stage("subset") as rec:
+        data = data[data.obs[add[0]] == add[1]] if add is not None else data[:, :]
+        rec["shape"] = data.shape
+    return data
+
+
+# from sccoda_reference_finding.ipynb; DA_analysis_reference_finding.find_references recomputes candidates
+sccoda_references = {
+    "Genus": "Bacteria*Proteobacteria*Gammaproteobacteria*Burkholderiales*Sutterellaceae*Parasutterella",
+    "Family": "Bacteria*Proteobacteria*Gammaproteobacteria*Burkholderiales*Sutterellaceae",
+    "Order": "Bacteria*Proteobacteria*Gammaproteobacteria*Burkholderiales",
+    "Class": "Bacteria*Proteobacteria*Gammaproteobacteria",
+    "Phylum": "Bacteria*Proteobacteria",
+}
+
+
+def sccoda_module():
+    global mod
+    if mod is None:
+        import sccoda.util.comp_ana
+        mod = sccoda.util.comp_ana
+    return mod
+
+
+sccoda_formula = "C(host_disease, Treatment('Healthy'))"
+
+
+def sccoda_posterior_path(posterior_dir, name, data, formula, reference, sampler):
+    # posteriors are keyed by the counts, samples, taxa and groups of the data, the model and the sampler settings
+    h = hashlib.md5()
+    X = data.X.toarray() if sp.issparse(data.X) else np.asarray(data.X)
+    h.update(np.ascontiguousarray(X, dtype=float).tobytes())
+    for names in [data.obs_names, data.var_names, data.obs["host_disease"].astype(str)]:
+        h.update("\t".join(names).encode())
+    h.update(json.dumps([formula, reference, sampler], sort_keys=True, default=str).encode())
+    return os.path.join(posterior_dir, f"{name}_{h.hexdigest()[:12]}.pkl")
+
+
+def slim_sccoda_result(result):
+    # the parts of a CAResult that summary_prepare uses. The concentrations and predictions (draws x samples x taxa)
+    # are dropped, they are most of its size
+    return type(result)(result.sampling_stats, result.model_specs,
+                        posterior=result.posterior[["alpha", "beta", "ind", "b_raw"]],
+                        sample_stats=result.sample_stats, observed_data=result.observed_data)
+
+
+def write_sccoda_posterior(result, posterior_file):
+    os.makedirs(os.path.dirname(posterior_file) or ".", exist_ok=True)
+    tmp_file = f"{posterior_file}.{os.getpid()}.tmp"
+    result.save(tmp_file)
+    os.replace(tmp_file, posterior_file)
+
+
+def read_sccoda_posterior(posterior_file):
+    with open(posterior_file, "rb") as f:
+        return pickle.load(f)
+
+
+def sccoda_posteriors(data, references, formula=sccoda_formula, posterior_dir=None, name="sccoda", n_chains=None,
+                      sampler_kwargs=None):
+    # {reference: CAResult} for every reference taxon. With posterior_dir, every (data, reference) is sampled once and
+    # its posterior is cached there ({name}_{key}.pkl); summary_prepare can evaluate it for any FDR level.
+    # References without cached posterior are sampled together in one batched HMC run, or with n_chains parallel chains
+    # each (DA_analysis_sccoda_sampling). sampler_kwargs go to the sampler
+    sampler_kwargs = sampler_kwargs or {}
+    sampler = dict(sampler_kwargs, n_chains=n_chains)
+
+    results = {}
+    paths = {}
+    if posterior_dir is not None:
+        for r in references:
+            paths[r] = sccoda_posterior_path(posterior_dir, name, data, formula, r, sampler)
+            if os.path.exists(paths[r]):
+                with prof.stage("read_posterior"):
+                    results[r] = read_sccoda_posterior(paths[r])
+    missing = [r for r in references if r not in results]
+
+    if n_chains is not None:
+        # n_chains chains in parallel processes, stopped once R-hat/ESS of the inclusion indicators converged
+        import DA_analysis_sccoda_sampling as ss
+        for r in missing:
+            with prof.stage("sampling", shape=data.shape, n_chains=n_chains):
+                results[r] = ss.sample_hmc_parallel(data, formula, r, n_chains=n_chains, **sampler_kwargs)
+    elif len(missing) > 1:
+        import DA_analysis_sccoda_sampling as ss
+        with prof.stage("sampling", shape=data.shape, n_references=len(missing)):
+            results.update(ss.sample_hmc_batched(data, formula, missing, **sampler_kwargs))
+    elif missing:
+        with prof.stage("model_setup", shape=data.shape):
+            model = sccoda_module().CompositionalAnalysis(data=data, formula=formula, reference_cell_type=missing[0])
+        with prof.stage("sampling"):
+            results[missing[0]] = model.sample_hmc(**sampler_kwargs)
+
+    if posterior_dir is not None:
+        for r in missing:
+            results[r] = slim_sccoda_result(results[r])
+            with prof.stage("write_posterior"):
+                write_sccoda_posterior(results[r], paths[r])
+    return dict([(r, results[r]) for r in references])
+
+
+def posterior_name(author, level, add=None):
+    return f"{author.lower()}_{level.lower()}" + (f"_{add[1]}" if add is not None else "")
+
+
+def run_sccoda(author, level, data_dir, add=None, fdr_level=0.1, cache_dir=None, sparse=False, n_chains=None,
+               sampler_kwargs=None, finest=None, references=None, posterior_dir=None, budget=None, n_subsets=5,
+               subset_workers=None):
+    # with posterior_dir, runs with another fdr_level reuse the cached posterior instead of sampling again.
+    # With a budget (DA_analysis_resources.Budget), runs that would not fit are done with a shorter chain or on
+    # n_subsets balanced Healthy/IBS subsets, whose effects are combined
+    if references is None:
+        references = sccoda_references
+
+    data = prepared_data(author, level, data_dir, add=add, cache_dir=cache_dir, sparse=sparse, finest=finest)
+    if budget is not None:
+        import DA_analysis_resources as rsrc
+        with prof.stage("resource_plan", shape=data.shape) as rec:
+            plan = rsrc.plan_sccoda(data.n_obs, data.n_vars, budget, sampler_kwargs=sampler_kwargs,
+                                    n_subsets=n_subsets, n_workers=subset_workers)
+            rec.update(mode=rsrc.describe_plan(plan), est_mem_gb=round(plan["estimate"].mem_gb, 2),
+                       est_hours=round(plan["estimate"].hours, 2))
+        print(f"scCODA {author} {level}: {rsrc.describe_plan(plan)} run, about {plan['estimate'].mem_gb:.1f} GB "
+              f"and {plan['estimate'].hours:.1f} h each")
+        sampler_kwargs = plan["sampler_kwargs"]
+        if plan["mode"] == "subsampled":
+            with prof.stage("sampling_subsets", n_subsets=plan["n_subsets"], max_samples=plan["max_samples"]):
+                effect_df = rsrc.run_subsampled(densify(data), sccoda_formula, references[level], fdr_level, plan)
+            return rsrc.mark_downscaled(effect_df, plan)
+
+    result = sccoda_posteriors(densify(data), [references[level]], posterior_dir=posterior_dir,
+                               name=posterior_name(author, level, add), n_chains=n_chains,
+                               sampler_kwargs=sampler_kwargs)[references[level]]
+    with prof.stage("summary_prepare"):
+        _, effect_df = result.summary_prepare(est_fdr = fdr_level)
+
+    if budget is not None:
+        effect_df = rsrc.mark_downscaled(effect_df, plan)
+    return effect_df
 
-    meta = pandas2ri.py2rpy(data.obs)
-    otus = pandas2ri.py2rpy(pd.DataFrame(data.X.T))
 
-    linda = rpackages.importr("LinDA")
+def run_sccoda_references(author, level, data_dir, candidates=None, fdr_levels=(0.1, 0.2), add=None, cache_dir=None,
+                          sparse=False, n_chains=None, sampler_kwargs=None, finest=None, posterior_dir=None):
+    # sensitivity to the reference: effects for every candidate reference taxon of `level` (default: the one of
+    # sccoda_references) and FDR level, as {(reference, fdr_level): effect_df}. Each posterior is sampled only once
+    if candidates is None:
+        candidates = [sccoda_references[level]]
+
+    data = prepared_data(author, level, data_dir, add=add, cache_dir=cache_dir, sparse=sparse, finest=finest)
+    results = sccoda_posteriors(densify(data), list(candidates), posterior_dir=posterior_dir,
+                                name=posterior_name(author, level, add), n_chains=n_chains,
+                                sampler_kwargs=sampler_kwargs)
+    out = {}
+    for r, result in results.items():
+        for alpha in fdr_levels:
+            with prof.stage("summary_prepare"):
+                out[(r, alpha)] = result.summary_prepare(est_fdr=alpha)[1]
+    return out
 
-    lo = linda.linda(otus, meta, formula=f"~{formula}", alpha=alpha,
-                     prev_cut=0, lib_cut=1)
 
-    out = pd.DataFrame(lo[2][0])
-    out.index = data.var.index
+def run_ancombc_model(author, level, data_dir, add=None, alpha=0.05, cache_dir=None, sparse=False, finest=None):
+    data = prepared_data(author, level, data_dir, add=add, cache_dir=cache_dir, sparse=sparse, finest=finest)
+
+    # new dense float matrix, the (cached) input is not modified
+    with prof.stage("zero_replacement", shape=data.shape):
+        data = pp.replace_zeros(data, 0.5)
+
+    with prof.stage("r_fit"):
+        return rb.fit_ancombc([data], alpha=alpha, covariate_column="host_disease")[0]
+
+
+def run_linda_model(author, level, data_dir, add=None, alpha=0.05, formula="host_disease", cache_dir=None, sparse=False,
+                    finest=None):
+    data = prepared_data(author, level, data_dir, add=add, cache_dir=cache_dir, sparse=sparse, finest=finest)
+
+    with prof.stage("r_fit", shape=data.shape):
+        return rb.fit_linda([data], alpha=alpha, formula=formula)[0]
+
+
+def format_results(res_, method, a, add, l):
+    if method == "sccoda":
+        res_ = res_.reset_index()
+        res_["Is credible"] = (res_["Final Parameter"] != 0)
+    elif method == "ANCOMBC":
+        res_ = res_.reset_index().rename(columns={
+            "index": "Cell Type",
+            "is_da": "Is credible"
+        })
+    elif method == "LinDA":
+        res_ = res_.reset_index().rename(columns={
+            "index": "Cell Type",
+            "padj": "p_adj"
+        })
+        res_["Is credible"] = [False if x == 0 else True for x in res_["reject"]]
+    res_["author"] = a
+    if add in ["stool", "sigmoid"]:
+        res_["source"] = add
+    elif a == "Mars":
+        res_["source"] = "sigmoid"
+    else:
+        res_["source"] = "stool"
 
-    return out
+    tax = get_phylo_levels(res_, l)
+    res_ = pd.merge(res_, tax, left_index=True, right_index=True)
+    return res_
 
 
-def read_authors_results(authors, data_dir, method, adds=None, alpha=None, run_no=None):
+def result_file_name(a, l, add, method, alpha=None, run_no=None):
+    name = f"{a.lower()}_{l.lower()}"
+    if add:
+        name += f"_{add}"
+    name += f"_{method}"
+    if alpha:
+        name += f"_alpha_{alpha}"
+    if run_no:
+        name += f"_{run_no}"
+    return name + ".csv"
+
+
+def read_authors_results(authors, data_dir, method, adds=None, alpha=None, run_no=None, store=None):
+    # store: results database (see DA_analysis_results_store), queried instead of scanning data_dir
+    if store is not None:
+        return read_store_results(authors, store, method, adds=adds, alpha=alpha, run_no=run_no)
+
     out_dict = {}
 
     for l in tax_levels[1:]:
@@ -173,103 +443,169 @@ def read_authors_results(authors, data_dir, method, adds=None, alpha=None, run_n
             subdir_name = [x for x in os.listdir(data_dir) if x.startswith(a + "-")][0]
 
             for add in adds[a]:
-                name = f"{a.lower()}_{l.lower()}"
-                if add:
-                    name += f"_{add}"
-                name += f"_{method}"
-                if alpha:
-                    name += f"_alpha_{alpha}"
-                if run_no:
-                    name += f"_{run_no}"
-                name += ".csv"
+                name = result_file_name(a, l, add, method, alpha, run_no)
 
                 for f in os.listdir(data_dir + subdir_name):
 
                     if f == name:
                         res_ = pd.read_csv(data_dir + subdir_name + "/" + f, index_col=0)
-                        if method == "sccoda":
-                            res_ = res_.reset_index()
-                            res_["Is credible"] = (res_["Final Parameter"] != 0)
-                        elif method == "ANCOMBC":
-                            res_ = res_.reset_index().rename(columns={
-                                "index": "Cell Type",
-                                "is_da": "Is credible"
-                            })
-                        elif method == "LinDA":
-                            res_ = res_.reset_index().rename(columns={
-                                "index": "Cell Type",
-                                "padj": "p_adj"
-                            })
-                            res_["Is credible"] = [False if x == 0 else True for x in res_["reject"]]
-                        res_["author"] = a
-                        if add in ["stool", "sigmoid"]:
-                            res_["source"] = add
-                        elif a == "Mars":
-                            res_["source"] = "sigmoid"
-                        else:
-                            res_["source"] = "stool"
-
-                        tax = get_phylo_levels(res_, l)
-                        res_ = pd.merge(res_, tax, left_index=True, right_index=True)
-                        ll.append(res_)
+                        ll.append(format_results(res_, method, a, add, l))
         out_dict[l] = pd.concat(ll)
 
     return out_dict
 
 
-def get_significances(out_dict, method):
-    res_sigs = {}
+def read_store_results(authors, store, method, adds=None, alpha=None, run_no=None):
+    import DA_analysis_results_store as rs
+
+    # one indexed query for all authors and levels
+    found = {}
+    for a, l, add, _, _, _, res_ in rs.query_results(store, method=method, author=list(authors),
+                                                     alpha=alpha if alpha else None, run_no=run_no if run_no else None):
+        found[(a, l, add)] = res_
+
+    out_dict = {}
     for l in tax_levels[1:]:
+        ll = []
+        for a in authors:
+            for add in adds[a]:
+                if (a, l, add if add else None) in found:
+                    ll.append(format_results(found[(a, l, add if add else None)], method, a, add, l))
+        out_dict[l] = pd.concat(ll)
+
+    return out_dict
+
 
-        res = out_dict[l]
-
-        if method == "sccoda" or method == "scCODA":
-            res_sig_gr = res.groupby("Cell Type").agg({
-                "Kingdom": "first",
-                "Phylum": "first",
-                "Class": "first",
-                "Order": "first",
-                "Family": "first",
-                "Genus": "first",
-                "Is credible": "sum",
-                "Final Parameter": [lambda x: (x > 0).sum(), lambda x: (x < 0).sum()],
-            },
-            )
-            res_sig_gr.columns = ["Increase" if j == "<lambda_0>" else
-                                  "Decrease" if j == "<lambda_1>" else
-                                  "count" if i == "Is credible" else
-                                  i for i, j in res_sig_gr.columns]
-        elif method == "LinDA":
-            res["eff"] = res.apply(lambda row: row["stat"] if row["reject"]==1 else 0, axis=1)
-            res_sig_gr = res.groupby("Cell Type").agg({
-                "Kingdom": "first",
-                "Phylum": "first",
-                "Class": "first",
-                "Order": "first",
-                "Family": "first",
-                "Genus": "first",
-                "Is credible": "sum",
-                "eff": [lambda x: (x > 0).sum(), lambda x: (x < 0).sum()],
-            },
-            )
-            res_sig_gr.columns = ["Increase" if j == "<lambda_0>" else
-                                  "Decrease" if j == "<lambda_1>" else
-                                  "count" if i == "Is credible" else
-                                  i for i, j in res_sig_gr.columns]
+# concurrent reads of read_results; the threads mostly wait for the file system
+read_workers = 16
+
+
+def per_method(x, method):
+    # alpha/run_no of read_results: one value for all methods or {method: value}
+    return x.get(method) if isinstance(x, dict) else x
+
+
+def read_results(authors, data_dir, methods, adds, alpha=None, run_no=None, levels=tax_levels[1:], max_workers=None,
+                 store=None, categorical=True):
+    # results of all methods x authors x levels x sample groups, read concurrently by max_workers threads
+    # (default read_workers). alpha and run_no are one value or a {method: value} dict.
+    # Returns one tidy frame of format_results with "model" (the method) and "level" columns;
+    # results_by_level gives the {level: frame} dict of one model for get_significances.
+    # categorical: compact frame (see categorical_results)
+    if max_workers is None:
+        max_workers = read_workers
+    tasks = [(m, a, l, add) for m in methods for l in levels for a in authors for add in adds[a]]
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        if store is not None:
+            import DA_analysis_results_store as rs
+            # one indexed query per method
+            def query(m):
+                return rs.query_results(store, method=m, author=list(authors), alpha=per_method(alpha, m) or None,
+                                        run_no=per_method(run_no, m) or None)
+
+            found = dict([((m, a, l, add), res_) for m, rows in zip(methods, pool.map(query, methods))
+                          for a, l, add, _, _, _, res_ in rows])
+
+            def read(task):
+                m, a, l, add = task
+                return found.get((m, a, l, add if add else None))
         else:
-            res_sig_gr = res.groupby("Cell Type").agg({
-                "Kingdom": "first",
-                "Phylum": "first",
-                "Class": "first",
-                "Order": "first",
-                "Family": "first",
-                "Genus": "first",
-                "Is credible": "sum"
-            }).rename(columns={"Is credible": "count"})
+            subdirs = os.listdir(data_dir)
+            paths = dict([(a, data_dir + [x for x in subdirs if x.startswith(a + "-")][0]) for a in authors])
+            files = dict(zip(authors, [set(x) for x in pool.map(os.listdir, [paths[a] for a in authors])]))
+
+            def read(task):
+                m, a, l, add = task
+                name = result_file_name(a, l, add, m, per_method(alpha, m), per_method(run_no, m))
+                if name in files[a]:
+                    return pd.read_csv(paths[a] + "/" + name, index_col=0)
+                return None
+
+        def load(task):
+            res_ = read(task)
+            if res_ is None:
+                return None
+            m, a, l, add = task
+            return format_results(res_, m, a, add, l).assign(model=m, level=l)
+
+        frames = [x for x in pool.map(load, tasks) if x is not None]
+
+    results = pd.concat(frames, ignore_index=True)
+    return categorical_results(results) if categorical else results
+
+
+def categorical_results(results):
+    # integer taxon IDs, lineages and taxonomy as categoricals of the taxonomy registry and categorical labels.
+    # Every lineage string and taxon name is then stored once instead of once per row
+    results = results.copy()
+    ids = tx.registry.ids(results["Cell Type"])
+    results["taxon_id"] = ids
+    results["Cell Type"] = pd.Categorical.from_codes(ids, categories=tx.registry.lineages)
+    tax = tx.registry.table(ids)
+    for l in tax_levels:
+        results[l] = tax[l].values
+    for c in ["model", "level", "author", "source"]:
+        results[c] = results[c].astype("category")
+    return results
+
+
+def results_by_level(results, model, levels=tax_levels[1:]):
+    # {level: frame} of one model from read_results, like read_authors_results.
+    # Columns of the other models are dropped, taxonomy columns below the level are NaN as in the single files.
+    # Integer columns that only some models have (e.g. diff_abn of ANCOM-BC) are float in the combined frame
+    res = results[results["model"] == model]
+    cols = [c for c in res.columns if c != "level" and (c in tax_levels or res[c].notna().any())]
+
+    out = {}
+    for l in levels:
+        df = res.loc[res["level"] == l, cols]
+        # plain columns again, as the notebooks edit them (e.g. fillna("_"))
+        cat = [c for c in cols if isinstance(df[c].dtype, pd.CategoricalDtype)]
+        out[l] = df.astype(dict([(c, object) for c in cat])).infer_objects()
+    return out
+
+
+def get_significances(out_dict, method):
+    levels = tax_levels[1:]
 
-        res_sig_gr["model"] = method
+    # as before, LinDA inputs get their effect column "eff" (stat of rejected hypotheses, otherwise 0), which the
+    # notebooks use later on
+    if method == "LinDA":
+        for l in levels:
+            out_dict[l]["eff"] = out_dict[l]["stat"].where(out_dict[l]["reject"] == 1, 0)
 
-        res_sigs[l] = res_sig_gr
+    # all levels stacked into one frame, so there is only one grouped pass
+    res = pd.concat([out_dict[l] for l in levels], keys=levels, names=["level"]).reset_index(level="level")
+
+    agg = dict([(t, "first") for t in tax_levels])
+    agg["Is credible"] = "sum"
+
+    # effect signs as indicator columns, counted with built-in sums
+    if method == "sccoda" or method == "scCODA":
+        eff = res["Final Parameter"]
+    elif method == "LinDA":
+        eff = res["eff"]
+    else:
+        eff = None
+    if eff is not None:
+        res["Increase"] = eff > 0
+        res["Decrease"] = eff < 0
+        agg["Increase"] = "sum"
+        agg["Decrease"] = "sum"
+
+    # grouped by integer taxon IDs instead of lineage strings
+    if "taxon_id" not in res.columns:
+        res["taxon_id"] = tx.registry.ids(res["Cell Type"])
+    res_sig_all = res.groupby(["level", "taxon_id"]).agg(agg).rename(columns={"Is credible": "count"})
+    res_sig_all["model"] = method
+
+    res_sigs = {}
+    for l in levels:
+        sig = res_sig_all.xs(l, level="level")
+        sig.index = pd.Index(tx.registry.names(sig.index), name="Cell Type")
+        # taxonomy columns keep their per-level dtypes (all-NaN columns below the level are float)
+        res_sigs[l] = sig.sort_index().astype(dict(out_dict[l].dtypes[tax_levels]))
 
     return res_sigs
 
@@ -277,28 +613,33 @@ def get_significances(out_dict, method):
 def get_phylo_levels(results, level, col="Cell Type"):
 
     max_level_id = tax_levels.index(level)+1
-    cols = tax_levels
+    # every lineage is split only once per process (taxonomy registry)
+    tax_table = tx.registry.table(tx.registry.ids(results[col]), n_levels=max_level_id, categorical=False)
+    tax_table.index = results.index
+    return tax_table
 
-    tax_table = pd.DataFrame(columns=cols, index=np.arange(len(results)))
-    for i in range(len(results)):
-        char = results.loc[i, col]
-        split = char.split(sep="*")
-        for j in range(max_level_id):
-            try:
-                tax_table.iloc[i, j] = split[j]
-            except IndexError:
-                tax_table.iloc[i, j] = None
 
-    return tax_table
+def taxonomy_children(df_):
+    # for every level: node name -> unique names below it on the next level (in order of appearance).
+    # One pass per level over the table, instead of one scan of the table per node
+    children = []
+    for i in range(df_.shape[1] - 1):
+        pairs = df_.iloc[:, [i, i+1]]
+        pairs = pairs[pd.notna(pairs.iloc[:, 0])].drop_duplicates()
 
+        ch = {}
+        for a, b in zip(pairs.iloc[:, 0], pairs.iloc[:, 1]):
+            ch.setdefault(a, []).append(b)
+        children.append(ch)
 
-def traverse(df_, a, i, innerl):
-    if i+1 < df_.shape[1]:
-        a_inner = pd.unique(df_.loc[np.where(df_.iloc[:, i] == a)].iloc[:, i+1])
+    return children
 
+
+def traverse(children, a, i, innerl):
+    if i < len(children):
         desc = []
-        for b in a_inner:
-            desc.append(traverse(df_, b, i+1, innerl))
+        for b in children[i].get(a, []):
+            desc.append(traverse(children, b, i+1, innerl))
         if innerl:
             il = a
         else:
@@ -313,18 +654,41 @@ def traverse(df_, a, i, innerl):
 def df2newick(df, inner_label=True, tax_lev=tax_levels):
 
     df_tax = df.loc[:, [x for x in tax_lev if x in df.columns]]
+    children = taxonomy_children(df_tax)
 
     alevel = pd.unique(df_tax.iloc[:, 0])
     strs = []
     for a in alevel:
-        strs.append(traverse(df_tax, a, 0, inner_label))
+        strs.append(traverse(children, a, 0, inner_label))
 
     newick = f"({','.join(strs)});"
     return newick
 
 
+def node_heights(nodes):
+    # same as node.height in toytree (tree height minus distance from the root), for nodes in level order
+    depth = {}
+    for n in nodes:
+        depth[n] = 0. if n.up is None or n.up not in depth else depth[n.up] + n.dist
+    tree_height = max(depth.values())
+    return dict([(n, tree_height - d) for n, d in depth.items()])
+
+
+def effect_index(data_all, tax_levels=tax_levels):
+    effects = {}
+    for l in tax_levels:
+        sub = data_all[data_all["level"] == l]
+        for name, ct, e in zip(sub[l], sub["Cell Type"], sub["Final Parameter"]):
+            effects.setdefault((l, name), []).append((ct, e))
+    return effects
+
+
 def build_fancy_tree(data, edge_color_dict=None, other_col="lightblue", tax_levels=["Kingdom", "Phylum", "Class", "Order", "Family", "Genus"], leaf_level="Genus", make_leaf_dict=False):
 
+    import toytree as tt
+    import toyplot
+    import toyplot.color
+
     data_all = pd.concat(data.values())
 
     if make_leaf_dict:
@@ -374,10 +738,22 @@ def build_fancy_tree(data, edge_color_dict=None, other_col="lightblue", tax_leve
 
     markers = []
 
-    max_height = np.max([n.height - 2 for n in tree.treenode.traverse()])
-    c = 0
-    for n in tree.treenode.traverse():
-        if n.height == max_height:
+    # effect lookup, built once: (level, taxon name) -> [(full name, effect), ...]
+    data_all["level"] = "Kingdom"
+    for l in tax_levels[1:]:
+        data_all.loc[pd.notna(data_all[l]), "level"] = l
+    effects = effect_index(data_all, tax_levels)
+
+    # toytree recomputes node.height from the whole tree on every access, so heights are computed once here
+    nodes = list(tree.treenode.traverse())
+    heights = node_heights(nodes)
+    max_height = np.max([heights[n] - 2 for n in nodes])
+
+    # nodes come in level order, so ancestors are handled before their descendants
+    clade_color = {}
+    for n in nodes:
+        # edge colors
+        if heights[n] == max_height:
             if n.name in edge_color_dict.keys():
                 col = edge_color_dict[n.name]
                 if type(col) == str:
@@ -388,53 +764,37 @@ def build_fancy_tree(data, edge_color_dict=None, other_col="lightblue", tax_leve
                 markers.append((n.name, m))
             else:
                 col = other_col
+            clade_color[n] = col
             n.add_feature("edge_color", col)
-            for n_ in n.get_descendants():
-                n_.add_feature("edge_color", col)
-
-
-
-            c += 1
-        elif n.height > max_height:
+        elif heights[n] > max_height:
             n.add_feature("edge_color", "black")
+        elif n.up in clade_color:
+            clade_color[n] = clade_color[n.up]
+            n.add_feature("edge_color", clade_color[n])
 
-    m = toyplot.marker.create(shape="o", size=8, mstyle={"fill": other_col})
-    markers.append(("other", m))
-
-    # assign taxonomic levels to nodes
-    for n in tree.treenode.traverse():
-        if n.height == "":
+        # taxonomic level
+        if heights[n] == "":
             l = tax_levels[-1]
-        elif n.height >= len(tax_levels):
+        elif heights[n] >= len(tax_levels):
             l = ""
         else:
-            l = tax_levels[-(int(n.height) + 1)]
+            l = tax_levels[-(int(heights[n]) + 1)]
         n.add_feature("tax_level", l)
 
-    # add effects
-    data_all["level"] = "Kingdom"
-    for l in tax_levels[1:]:
-        data_all.loc[pd.notna(data_all[l]), "level"] = l
-
-    for n in tree.treenode.traverse():
-        if n.tax_level == "":
+        # effect
+        matches = effects.get((l, n.name), []) if l != "" else []
+        if len(matches) == 0:
             n.add_feature("effect", 0)
+        elif len(matches) == 1:
+            n.add_feature("effect", matches[0][1])
         else:
-            l = data_all.loc[(data_all["level"] == n.tax_level) & (data_all[n.tax_level] == n.name), :]
-            if len(l) == 1:
-                n.add_feature("effect", l["Final Parameter"].values[0])
-            elif len(l) == 0:
-                n.add_feature("effect", 0)
-            elif len(l) > 1:
-                par_names = [n.name] + [m.name for m in n.get_ancestors()][:-1]
-                par_names.reverse()
-                full_name = '*'.join(par_names)
-                ll = l[l["Cell Type"] == full_name]
-                n.add_feature("effect", ll["Final Parameter"].values[0])
-
-
-    # add node colors
-    for n in tree.treenode.traverse():
+            # taxon name is not unique on this level, use the full path instead
+            par_names = [n.name] + [m.name for m in n.get_ancestors()][:-1]
+            par_names.reverse()
+            full_name = '*'.join(par_names)
+            n.add_feature("effect", [e for ct, e in matches if ct == full_name][0])
+
+        # node color
         if np.sign(n.effect) == 1:
             n.add_feature("color", "black")
         elif np.sign(n.effect) == -1:
@@ -442,4 +802,7 @@ def build_fancy_tree(data, edge_color_dict=None, other_col="lightblue", tax_leve
         else:
             n.add_feature("color", "cyan")
 
+    m = toyplot.marker.create(shape="o", size=8, mstyle={"fill": other_col})
+    markers.append(("other", m))
+
     return tree, markers